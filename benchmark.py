@@ -0,0 +1,296 @@
+import os
+import sys
+import json
+import time
+import shutil
+import zipfile
+import platform
+import tempfile
+import subprocess
+import numpy as np
+from argparse import ArgumentParser
+from scipy.spatial.transform import Rotation
+
+from egl_renderer import PointCloudRenderer
+from egl_renderer.libegl import EGLContext
+from egl_renderer.utils import load_pc_from_zip
+from egl_renderer.scan_cache import PointCloudArrays
+from OpenGL.GL import glFinish, glDeleteBuffers, glDeleteProgram, glGetString, GL_VENDOR, GL_RENDERER, GL_VERSION
+
+script_dir = os.path.dirname(os.path.abspath(__file__))
+
+
+def generate_pointcloud(points_count, room_size=(10., 8., 3.), seed=0):
+    # Points on the walls, floor and ceiling of a box-shaped room, similar to the density of a real indoor scan
+    rng = np.random.default_rng(seed)
+    room_size = np.array(room_size)
+    verts = rng.random((points_count, 3)) * room_size
+    axes = rng.integers(0, 3, points_count)
+    sides = rng.integers(0, 2, points_count)
+    verts[np.arange(points_count), axes] = sides * room_size[axes]
+    verts += rng.normal(scale=0.005, size=verts.shape)
+    colors = np.empty((points_count, 4), dtype=np.uint8)
+    colors[:, :3] = (np.abs(np.sin(verts * [1.3, 0.7, 2.1])) * 255).astype(np.uint8)
+    colors[:, 3] = 255
+    return PointCloudArrays(verts.astype(np.float32), colors)
+
+
+def generate_trajectory(frames_count, room_size=(10., 8., 3.), height=1.6):
+    # Camera walks along an ellipse inside the room, looking forward; quaternions are (w, x, y, z)
+    angles = np.linspace(0, 2 * np.pi, frames_count, endpoint=False)
+    center = np.array(room_size[:2]) / 2
+    positions = np.column_stack([center[0] + center[0] * 0.6 * np.cos(angles),
+                                 center[1] + center[1] * 0.6 * np.sin(angles), np.full(frames_count, height)])
+    forward = np.column_stack([-np.sin(angles), np.cos(angles), np.zeros(frames_count)])
+    down = np.tile([0., 0., -1.], (frames_count, 1))
+    right = np.cross(down, forward)
+    quats = Rotation.from_matrix(np.stack([right, down, forward], axis=-1)).as_quat()
+    return np.roll(quats, 1, axis=1), positions
+
+
+def write_pointcloud_zip(path, pointcloud, datapath='scan/pointcloud.ply'):
+    records = np.empty(len(pointcloud.vertices), dtype=[('x', '<f4'), ('y', '<f4'), ('z', '<f4'), ('red', 'u1'),
+                                                        ('green', 'u1'), ('blue', 'u1'), ('alpha', 'u1')])
+    for ind, name in enumerate('xyz'):
+        records[name] = pointcloud.vertices[:, ind]
+    for ind, name in enumerate(['red', 'green', 'blue', 'alpha']):
+        records[name] = pointcloud.colors[:, ind]
+    header = "ply\nformat binary_little_endian 1.0\nelement vertex {}\n".format(len(records)) + \
+             "".join("property float {}\n".format(x) for x in 'xyz') + \
+             "".join("property uchar {}\n".format(x) for x in ['red', 'green', 'blue', 'alpha']) + "end_header\n"
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED, compresslevel=1) as output_zip:
+        output_zip.writestr(datapath, header.encode('ASCII') + records.tobytes())
+
+
+def write_trajectory_json(path, quats, positions):
+    with open(path, 'w') as output_file:
+        json.dump({str(ind): {'quaternion': quat.tolist(), 'position': pos.tolist()}
+                   for ind, (quat, pos) in enumerate(zip(quats, positions))}, output_file)
+
+
+def get_camera_params(camera_model, resolution, far=100.):
+    width, height = resolution
+    if camera_model == 'opencv':
+        return dict(image_size=resolution, focal_dist=[width * 0.45, width * 0.46], center=[width / 2, height / 2],
+                    distorsion_coeffs=[-0.25, 0.08, 0., 0., 0.], far=far)
+    if camera_model in ('ocam', 'ocam_fast'):
+        # Equidistant fisheye with a mild radial distortion, fitted with the usual 18-term inverse polynomial
+        thetas = np.linspace(-np.pi / 2, np.pi / 2, 500)
+        rhos = width * 0.2 * (thetas + np.pi / 2) * (1 - 0.03 * (thetas + np.pi / 2) ** 2)
+        invpol = np.zeros(18)
+        invpol[:12] = np.polyfit(thetas, rhos, 11)[::-1]
+        cameramodel_dict = {'OCamModel': {'cam2world': {'coeff': [0.] * 5}, 'world2cam': {'coeff': invpol.tolist()},
+                                          'cx': height / 2, 'cy': width / 2, 'c': 1., 'd': 0., 'e': 0.},
+                            'ImageSize': {'Width': width, 'Height': height}}
+        return dict(cameramodel_dict=cameramodel_dict, fov=200, far=far)
+    return dict(image_size=resolution, fov=60., far=far)
+
+
+def measure(fn, repeats, warmup=1):
+    for _ in range(warmup):
+        fn()
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return {'median': float(np.median(times)), 'mean': float(np.mean(times)), 'min': float(np.min(times)),
+            'repeats': repeats}
+
+
+def release_renderer(renderer):
+    for scene_object in list(renderer.objects):
+        renderer.remove_object(scene_object)
+    renderer.camera.release()
+    glDeleteProgram(renderer.shader.program)
+    renderer._delete_main_framebuffer()
+
+
+def benchmark_config(pointcloud, zippath, resolution, camera_models, repeats, frames_count=8):
+    results = []
+
+    def add_result(name, timing, **extra):
+        timing.update(name=name, points=len(pointcloud.vertices), resolution=list(resolution), **extra)
+        results.append(timing)
+        print("{:>28s} {:>9d} pts {:>4d}x{:<4d} {:9.2f} ms".format(name, len(pointcloud.vertices), *resolution,
+                                                                   timing['median'] * 1e3))
+
+    if zippath is not None:
+        add_result('load_pc_from_zip', measure(lambda: load_pc_from_zip(zippath, '*/pointcloud.ply'),
+                                               max(repeats // 4, 1), warmup=0))
+    quats, positions = generate_trajectory(frames_count)
+    for camera_model in camera_models:
+        camera_params = get_camera_params(camera_model, resolution)
+        renderer = PointCloudRenderer(*resolution)
+        renderer.init_opengl()
+
+        def init_context():
+            if hasattr(renderer, 'context'):
+                release_renderer(renderer)
+                renderer.init_opengl()
+            renderer.init_context(pointcloud, camera_model, **camera_params)
+            glFinish()
+
+        add_result('init_context/' + camera_model, measure(init_context, max(repeats // 4, 1), warmup=0))
+
+        frame_ind = [0]
+
+        def draw():
+            ind = frame_ind[0] % frames_count
+            frame_ind[0] += 1
+            renderer.locate_camera(quats[ind], positions[ind])
+            renderer.draw()
+            glFinish()
+
+        add_result('draw/' + camera_model, measure(draw, repeats))
+        if camera_model == 'opencv':
+            def draw_and_read_sync():
+                draw()
+                renderer.get_image()
+
+            def read_async():
+                renderer.get_requested_color(renderer.request_color_async(pbo), delete_pbo=False)
+
+            def draw_and_read_async():
+                draw()
+                read_async()
+
+            add_result('get_image', measure(renderer.get_image, repeats))
+            add_result('get_image_depth', measure(renderer.get_image_depth, repeats))
+            add_result('frame_sync', measure(draw_and_read_sync, repeats))
+            # request_color_async leaves the PBO bound, get_requested_color unbinds it
+            pbo = renderer.request_color_async()
+            renderer.get_requested_color(pbo, delete_pbo=False)
+            timing = measure(lambda: renderer.request_color_async(pbo), repeats)
+            renderer.get_requested_color(pbo, delete_pbo=False)
+            add_result('request_color_async', timing)
+            add_result('get_requested_color', measure(read_async, repeats))
+            add_result('frame_async', measure(draw_and_read_async, repeats))
+            glDeleteBuffers(1, [pbo])
+
+            def draw_and_read_all_sync():
+                draw()
+                renderer.get_image()
+                renderer.get_image_depth()
+
+            def draw_and_read_all_async():
+                # Keeps the ring full, so each call collects a frame requested a few frames earlier
+                if renderer.readback_ring.full():
+                    renderer.get_frame()
+                draw()
+                renderer.request_frame()
+
+            add_result('frame_sync/color_depth_ids', measure(draw_and_read_all_sync, repeats))
+            renderer.init_readback_ring(('color', 'depth', 'ids'))
+            add_result('frame_async/color_depth_ids', measure(draw_and_read_all_async, repeats))
+            while len(renderer.readback_ring) > 0:
+                renderer.get_frame()
+            renderer.readback_ring.release()
+            renderer.readback_ring = None
+        release_renderer(renderer)
+    return results
+
+
+def benchmark_end_to_end(zippath, resolution, frames_count, workdir):
+    loc_path = os.path.join(workdir, 'trajectory.json')
+    write_trajectory_json(loc_path, *generate_trajectory(frames_count))
+    # Runs as a separate process, so the timing includes startup and scan loading
+    command = [sys.executable, os.path.join(script_dir, 'render_visual_localization.py'), loc_path, zippath,
+               os.path.join(workdir, 'output.mp4'), '-c', '029756', '-res', str(resolution[0]), str(resolution[1]),
+               '--scan_cache', '']
+    start = time.perf_counter()
+    subprocess.run(command, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    elapsed = time.perf_counter() - start
+    return {'median': elapsed / frames_count, 'mean': elapsed / frames_count, 'min': elapsed / frames_count,
+            'repeats': 1, 'fps': frames_count / elapsed, 'total': elapsed}
+
+
+def get_gl_info():
+    return {'vendor': glGetString(GL_VENDOR).decode(), 'renderer': glGetString(GL_RENDERER).decode(),
+            'version': glGetString(GL_VERSION).decode()}
+
+
+def run(args):
+    resolutions = [tuple(int(x) for x in res.split('x')) for res in args.resolutions]
+    max_resolution = tuple(np.max(resolutions, axis=0))
+    ctx = EGLContext()
+    if not ctx.initialize(*max_resolution, device=args.device, surfaceless=True):
+        raise RuntimeError("Could not initialize OpenGL context")
+    report = {'meta': {'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'), 'platform': platform.platform(),
+                       'python': platform.python_version(), 'numpy': np.__version__, 'gl': get_gl_info(),
+                       'args': vars(args)},
+              'results': []}
+    print("Benchmarking on {renderer} ({version})".format(**report['meta']['gl']))
+    workdir = tempfile.mkdtemp(prefix='hps_benchmark_')
+    try:
+        for points_count in args.points:
+            pointcloud = generate_pointcloud(points_count)
+            zippath = os.path.join(workdir, 'scan_{}.zip'.format(points_count))
+            write_pointcloud_zip(zippath, pointcloud)
+            for ind, resolution in enumerate(resolutions):
+                report['results'] += benchmark_config(pointcloud, zippath if ind == 0 else None, resolution,
+                                                      args.camera_models, args.repeats)
+                if args.e2e_frames > 0:
+                    timing = benchmark_end_to_end(zippath, resolution, args.e2e_frames, workdir)
+                    timing.update(name='render_visual_localization', points=points_count,
+                                  resolution=list(resolution))
+                    report['results'].append(timing)
+                    print("{:>28s} {:>9d} pts {:>4d}x{:<4d} {:9.2f} fps".format(timing['name'], points_count,
+                                                                               *resolution, timing['fps']))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+        ctx.release()
+    with open(args.output, 'w') as output_file:
+        json.dump(report, output_file, indent=1)
+    print("Report saved to " + args.output)
+
+
+def compare(args):
+    # All timings are seconds per operation, so a larger median is a slowdown
+    base_report, new_report = [json.load(open(path)) for path in (args.base, args.new)]
+    get_key = lambda x: (x['name'], x['points'], tuple(x['resolution']))
+    base_results = {get_key(x): x for x in base_report['results']}
+    regressions = []
+    for result in new_report['results']:
+        key = get_key(result)
+        if key not in base_results:
+            continue
+        ratio = result['median'] / max(base_results[key]['median'], 1e-12)
+        status = ''
+        if ratio > 1 + args.threshold:
+            status = 'REGRESSION'
+            regressions.append(key)
+        elif ratio < 1 - args.threshold:
+            status = 'improvement'
+        print("{:>28s} {:>9d} pts {:>4d}x{:<4d} {:9.2f} -> {:9.2f} ms  x{:5.2f} {}".format(
+            key[0], key[1], *key[2], base_results[key]['median'] * 1e3, result['median'] * 1e3, ratio, status))
+    print("{} regressions over {:.0f}% threshold".format(len(regressions), args.threshold * 100))
+    return len(regressions) == 0
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    run_parser = subparsers.add_parser('run', help="Run the benchmark and save a JSON report")
+    run_parser.add_argument("-o", "--output", default="benchmark.json", help="Output report")
+    run_parser.add_argument("-p", "--points", nargs='+', type=int, default=[100000, 1000000],
+                            help="Point cloud sizes to sweep over")
+    run_parser.add_argument("-res", "--resolutions", nargs='+', default=['640x360', '1920x1080'],
+                            help="Resolutions to sweep over, as WIDTHxHEIGHT")
+    run_parser.add_argument("--camera_models", nargs='+', default=['opencv', 'ocam', 'ocam_fast', 'perspective'],
+                            help="Camera models to benchmark draw() for")
+    run_parser.add_argument("-r", "--repeats", type=int, default=20, help="Timed repeats of each operation")
+    run_parser.add_argument("--e2e_frames", type=int, default=30,
+                            help="Frames for the end-to-end render_visual_localization.py run (0 to skip)")
+    run_parser.add_argument("--device", default=None, help="EGL device index or DRM device path")
+    compare_parser = subparsers.add_parser('compare', help="Compare two reports")
+    compare_parser.add_argument("base", help="Baseline report")
+    compare_parser.add_argument("new", help="New report")
+    compare_parser.add_argument("-t", "--threshold", type=float, default=0.1,
+                                help="Relative slowdown reported as a regression")
+
+    args = parser.parse_args()
+    if args.command == 'run':
+        run(args)
+    elif not compare(args):
+        sys.exit(1)
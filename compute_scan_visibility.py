@@ -0,0 +1,57 @@
+import numpy as np
+from argparse import ArgumentParser
+
+from egl_renderer import PointCloudRenderer
+from egl_renderer.libegl import EGLContext
+from egl_renderer.utils import load_pc_from_zip
+from egl_renderer.scan_cache import ScanCache
+from egl_renderer.pose_track import PoseTrack
+from egl_renderer.camera import get_view_matrices
+from render_visual_localization import known_cameras
+
+
+def compute_visibility(args):
+    scan_cache = ScanCache(args.scan_cache, args.scan_cache_size) if args.scan_cache else None
+    try:
+        pointcloud = load_pc_from_zip(args.input_pczip, "pointcloud.ply", cache=scan_cache)
+    except FileNotFoundError:
+        pointcloud = load_pc_from_zip(args.input_pczip, "*/pointcloud.ply", cache=scan_cache)
+    camera = known_cameras[args.camera]
+    resolution = tuple(args.resolution) if args.resolution else camera['resolution']
+
+    ctx = EGLContext()
+    if not ctx.initialize(*resolution, device=args.device, surfaceless=True):
+        print('Could not initialize OpenGL context.')
+    renderer = PointCloudRenderer(*resolution)
+    renderer.init_opengl()
+    renderer.init_context(pointcloud, camera['camera_model'], image_size=resolution,
+                          focal_dist=camera['camera_params'][:2], center=camera['camera_params'][2:4],
+                          distorsion_coeffs=camera['camera_params'][4:]+[0.], far=args.far)
+
+    pose_track = PoseTrack.load(args.input_loc)
+    view_matrices = get_view_matrices(pose_track.quaternion[pose_track.valid], pose_track.position[pose_track.valid])
+    frames_visible, pixels_covered = renderer.render_visibility(view_matrices)
+    points_count = len(pointcloud.vertices)
+    np.savez(args.output, frames_visible=frames_visible[:points_count], pixels_covered=pixels_covered[:points_count],
+             frames_count=np.array(len(view_matrices)))
+    print("{} frames, {:.2%} of the scan points visible".format(len(view_matrices),
+                                                                 (frames_visible[:points_count] > 0).mean()))
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description="Counts in how many frames of a localization track each scan point is "
+                                        "visible and how many pixels it covers")
+    parser.add_argument("input_loc", help="Localization file")
+    parser.add_argument("input_pczip", help="3D scan zip file")
+    parser.add_argument("output", help="Output .npz with frames_visible and pixels_covered per scan point")
+    parser.add_argument("-res", "--resolution", nargs=2, type=int, help="Overwrite rendering resolution")
+    parser.add_argument("-c", "--camera", choices=list(known_cameras.keys()), required=True,
+                        help="Camera model (available choises: "+", ".join(sorted(known_cameras.keys()))+")")
+    parser.add_argument('--far', type=float, default=100., help="Maximum rendering distance")
+    parser.add_argument("--scan_cache", default="~/.cache/hps_dataset_scripts/scans",
+                        help="Directory for the binary scan cache (pass empty string to disable)")
+    parser.add_argument("--scan_cache_size", type=float, default=20., help="Maximum scan cache size in GB")
+    parser.add_argument("--device", default=None,
+                        help="EGL device index or DRM device path (default: EGL_RENDERER_DEVICE variable or first "
+                             "working device)")
+    compute_visibility(parser.parse_args())
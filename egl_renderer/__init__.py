@@ -1 +1,2 @@
-from .renderer import PointCloudRenderer
\ No newline at end of file
+from .renderer import PointCloudRenderer
+from .cpu_renderer import CPUPointCloudRenderer
@@ -1,44 +1,94 @@
 import numpy as np
 from abc import ABC, abstractmethod
-from OpenGL.GL import *
-import glm
-from scipy.spatial.transform import Rotation
+from .ubo import UniformBuffer
+
+
+def quats_to_matrices(quats):
+    # (N,4) quaternions in (w, x, y, z) order to (N,3,3) rotations, normalized like scipy's Rotation.from_quat
+    quats = np.asarray(quats, dtype=np.float64)
+    w, x, y, z = (quats / np.linalg.norm(quats, axis=-1, keepdims=True)).T
+    rotations = np.empty((len(quats), 3, 3))
+    rotations[:, 0, 0] = 1 - 2 * (y * y + z * z)
+    rotations[:, 0, 1] = 2 * (x * y - z * w)
+    rotations[:, 0, 2] = 2 * (x * z + y * w)
+    rotations[:, 1, 0] = 2 * (x * y + z * w)
+    rotations[:, 1, 1] = 1 - 2 * (x * x + z * z)
+    rotations[:, 1, 2] = 2 * (y * z - x * w)
+    rotations[:, 2, 0] = 2 * (x * z - y * w)
+    rotations[:, 2, 1] = 2 * (y * z + x * w)
+    rotations[:, 2, 2] = 1 - 2 * (x * x + y * y)
+    return rotations
+
+
+def quat_to_matrix(quat):
+    return quats_to_matrices(np.asarray(quat)[None])[0]
+
+
+def get_view_matrices(quats, positions, dtype=np.float32):
+    # World to camera matrices (inverse camera poses) of a whole trajectory, (N,4,4) in one pass
+    rotations_inv = quats_to_matrices(quats).transpose(0, 2, 1)
+    positions = np.asarray(positions, dtype=np.float64)
+    view_matrices = np.zeros((len(rotations_inv), 4, 4), dtype=dtype)
+    view_matrices[:, :3, :3] = rotations_inv
+    view_matrices[:, :3, 3] = -np.einsum('nij,nj->ni', rotations_inv, positions)
+    view_matrices[:, 3, 3] = 1
+    return view_matrices
 
 
 class BaseCameraModel(ABC):
+    # All camera state lives in the "Camera" uniform block of the shader, bound at this index
+    uniform_binding = 0
+    # Whether the projection maps the first image row to NDC y=-1, i.e. the framebuffer is already top-down
+    y_down = True
+
     def __init__(self, context, shader, name):
         self.context = context
         self.shader = shader
         self.model = name
+        self.context.camera_uniforms = UniformBuffer(shader.program, 'Camera', self.uniform_binding)
 
     def init_extrinsics(self, quat, pose):
-        R = Rotation.from_quat(np.roll(quat, -1)).as_matrix()
-        t = np.array([pose]).T
-        RT_inv = np.vstack([np.hstack([R.T, -np.matmul(R.T, t)]), [[0, 0, 0, 1]]])
+        self.set_view_matrix(get_view_matrices(np.asarray(quat)[None], np.asarray(pose)[None], np.float64)[0],
+                             pose)
 
-        self.context.View = glm.mat4(RT_inv.T.astype(np.float32).copy())
-        self.context.Model = glm.mat4(1.0)
-        self.context.MV = self.context.View * self.context.Model
-
-        self.context.shader_ids.update({'MV': glGetUniformLocation(self.shader.program, 'MV')})
+    def set_view_matrix(self, view_matrix, camera_position=None):
+        # Precomputed world to camera matrix, e.g. a row of get_view_matrices
+        view_matrix = np.asarray(view_matrix, dtype=np.float64)
+        if camera_position is None:
+            camera_position = -np.matmul(view_matrix[:3, :3].T, view_matrix[:3, 3])
+        self.context.view_matrix = view_matrix
+        self.context.camera_position = np.asarray(camera_position, dtype=np.float64)
+        self.context.camera_uniforms.set('camera_view', view_matrix)
 
     @abstractmethod
     def init_intrinsics(self, **kwargs):
         pass
 
-    def upload_extrinsics(self):
-        glUniformMatrix4fv(self.context.shader_ids['MV'], 1, GL_FALSE, glm.value_ptr(self.context.MV))
+    def upload(self):
+        # Intrinsics are sent once after init_intrinsics, a pose change only updates the view matrix
+        self.context.camera_uniforms.upload()
 
-    @abstractmethod
-    def upload_intrinsics(self):
-        pass
+    def release(self):
+        self.context.camera_uniforms.release()
 
-    def upload(self):
-        self.upload_extrinsics()
-        self.upload_intrinsics()
+    def get_visible_spheres(self, centers, radii, view_matrix=None):
+        # Culls against the current pose or the given world to camera matrix
+        RT_inv = self.context.view_matrix if view_matrix is None else view_matrix
+        centers_cam = np.matmul(centers, RT_inv[:3, :3].T) + RT_inv[:3, 3]
+        dists = np.linalg.norm(centers_cam, axis=1)
+        visible = dists - radii < self.context.far
+        view_axis, half_fov = self.get_view_cone()
+        if half_fov < np.pi:
+            inside = dists <= radii
+            safe_dists = np.maximum(dists, 1e-12)
+            axis_angle = np.arccos(np.clip(np.matmul(centers_cam, view_axis) / safe_dists, -1, 1))
+            sphere_angle = np.arcsin(np.clip(radii / safe_dists, 0, 1))
+            visible &= inside | (axis_angle - sphere_angle <= half_fov)
+        return visible
 
-    def locate_uniforms(self, keys):
-        self.context.shader_ids = {k: glGetUniformLocation(self.shader.program, k) for k in keys}
+    def get_view_cone(self):
+        # Optical axis in camera coordinates and half-angle of a cone containing the whole view
+        return np.array([0., 0., 1.]), np.pi
 
 
 class OcamModel(BaseCameraModel):
@@ -46,6 +96,10 @@ class OcamModel(BaseCameraModel):
         super().__init__(context, shader, "ocam")
 
     def init_intrinsics(self, cameramodel_dict, fov=360, far=20.):
+        self.parse_calibration(cameramodel_dict, fov, far)
+        self.update_uniforms()
+
+    def parse_calibration(self, cameramodel_dict, fov, far):
         ocammodel_dict = cameramodel_dict['OCamModel']
         # polynomial coefficients for the direct mapping function
         ocam_pol = [float(x) for x in ocammodel_dict['cam2world']['coeff']]
@@ -59,22 +113,65 @@ class OcamModel(BaseCameraModel):
         ocam_imsize = cameramodel_dict['ImageSize']
         ocam_img_size = np.array((int(ocam_imsize['Width']), int(ocam_imsize['Height'])))
 
+        self.context.ocam_img_size = ocam_img_size
         self.context.ocam_invpol = ocam_invpol / ocam_img_size[0] * 2
         self.context.ocam_center_off = ocam_xy_center / ocam_img_size[::-1] * 2 - 1
         self.context.ocam_theta_thresh = np.deg2rad(fov / 2) - np.pi / 2
         self.context.ocam_affine = ocam_affine.copy()
         self.context.ocam_affine[:2] *= ocam_img_size[0] / ocam_img_size[1]
         self.context.far = far
+        # Angular size of a pixel where the mapping is the densest
+        thetas = np.linspace(-np.pi / 2, np.deg2rad(fov / 2) - np.pi / 2, 1000)
+        rho_derivative = np.polyval(np.polyder(ocam_invpol[::-1]), thetas)
+        self.context.pixel_angle = 1. / np.abs(rho_derivative).max()
 
-        self.locate_uniforms(['ocam_invpol', 'ocam_affine', 'ocam_center_off', 'ocam_theta_thresh', 'far'])
+    def update_uniforms(self):
+        uniforms = self.context.camera_uniforms
+        uniforms.set('ocam_invpol', self.context.ocam_invpol, np.float64)
+        uniforms.set('ocam_affine', self.context.ocam_affine, np.float64)
+        uniforms.set('ocam_center_off', self.context.ocam_center_off, np.float64)
+        uniforms.set('far', self.context.far)
 
-    def upload_intrinsics(self):
-        glUniform1dv(self.context.shader_ids['ocam_invpol'], 18, self.context.ocam_invpol.astype(np.float64).copy())
-        glUniform3dv(self.context.shader_ids['ocam_affine'], 1, self.context.ocam_affine.astype(np.float64).copy())
-        glUniform2dv(self.context.shader_ids['ocam_center_off'], 1,
-                     self.context.ocam_center_off.astype(np.float64).copy())
-        glUniform1f(self.context.shader_ids['ocam_theta_thresh'], float(self.context.ocam_theta_thresh))
-        glUniform1f(self.context.shader_ids['far'], float(self.context.far))
+
+class OcamFastModel(OcamModel):
+    # Single-precision variant of the ocam model: theta->rho is sampled once into a table and linearly
+    # interpolated in the shader instead of evaluating the inverse polynomial in double for every vertex.
+    # The resulting projection error inside the field of view is measured on init and stored in
+    # context.ocam_lut_max_error (in pixels); with 256 samples it stays well below 0.1 px for usual calibrations
+    lut_size = 256
+
+    def __init__(self, context, shader):
+        BaseCameraModel.__init__(self, context, shader, "ocam_fast")
+
+    def init_intrinsics(self, cameramodel_dict, fov=360, far=20.):
+        self.parse_calibration(cameramodel_dict, fov, far)
+        # theta = -atan(z, |xy|) always lies in [-pi/2, pi/2]
+        theta_min, theta_max = -np.pi / 2, np.pi / 2
+        lut_thetas = np.linspace(theta_min, theta_max, self.lut_size)
+        invpol = self.context.ocam_invpol[::-1]
+        self.context.ocam_lut = np.polyval(invpol, lut_thetas).astype(np.float32)
+        self.context.ocam_lut_range = np.array([theta_min, (self.lut_size - 1) / (theta_max - theta_min)],
+                                               dtype=np.float32)
+
+        # Emulate the shader interpolation on a dense grid inside the field of view
+        thetas = np.linspace(theta_min, self.context.ocam_theta_thresh, 100001).astype(np.float32)
+        lut_pos = (thetas - self.context.ocam_lut_range[0]) * self.context.ocam_lut_range[1]
+        lut_ind = np.clip(lut_pos.astype(np.int32), 0, self.lut_size - 2)
+        lut_frac = lut_pos - lut_ind
+        rho_lut = self.context.ocam_lut[lut_ind] * (1 - lut_frac) + self.context.ocam_lut[lut_ind + 1] * lut_frac
+        rho_error = np.abs(rho_lut - np.polyval(invpol, thetas.astype(np.float64))).max()
+        # rho is normalized by half of the image width, affine terms scale it by up to the largest row norm
+        affine_scale = max(np.hypot(1, self.context.ocam_affine[2]), np.hypot(*self.context.ocam_affine[:2]))
+        self.context.ocam_lut_max_error = rho_error * affine_scale * self.context.ocam_img_size[0] / 2
+        self.update_uniforms()
+
+    def update_uniforms(self):
+        uniforms = self.context.camera_uniforms
+        uniforms.set('ocam_lut', self.context.ocam_lut)
+        uniforms.set('ocam_lut_range', self.context.ocam_lut_range)
+        uniforms.set('ocam_affine', self.context.ocam_affine)
+        uniforms.set('ocam_center_off', self.context.ocam_center_off)
+        uniforms.set('far', self.context.far)
 
 
 class OpenCVModel(BaseCameraModel):
@@ -91,28 +188,69 @@ class OpenCVModel(BaseCameraModel):
         self.context.center_off = (center/image_size*2 - 1).astype(np.float32).copy()
         self.context.distorsion_coeffs = distorsion_coeffs.astype(np.float32).copy()
         self.context.far = np.array(far).astype(np.float32).copy()
-        self.locate_uniforms(['distorsion_coeff', 'center_off', 'focal_dist', 'far'])
+        self.context.half_fov = self.get_half_fov(self.context.focal_dist, self.context.center_off,
+                                                  self.context.distorsion_coeffs)
+        self.context.pixel_angle = 1. / focal_dist.max()
+        self.update_uniforms()
+
+    @staticmethod
+    def get_half_fov(focal_dist, center_off, distorsion_coeffs, margin=1.05):
+        # Farthest image corner in normalized (distorted) coordinates
+        corners = np.maximum(np.abs(-1 - center_off), np.abs(1 - center_off)) / focal_dist
+        corner_radius = np.linalg.norm(corners) * margin
+        # Find the undistorted radius that reaches the corner while radial distortion is still monotonic
+        radii = np.linspace(0, 10, 10001)
+        radii_sq = radii ** 2
+        distorted = radii * (1 + distorsion_coeffs[0] * radii_sq + distorsion_coeffs[1] * radii_sq ** 2 +
+                             distorsion_coeffs[4] * radii_sq ** 3)
+        decreasing = np.flatnonzero(np.diff(distorted) <= 0)
+        monotonic_end = decreasing[0] if len(decreasing) > 0 else len(radii) - 1
+        reached = np.flatnonzero(distorted[:monotonic_end + 1] >= corner_radius)
+        if len(reached) == 0:
+            # Distortion folds back before reaching the corner, only the front half-space is safe
+            return np.pi / 2
+        return np.arctan(radii[reached[0]] * margin)
+
+    def get_view_cone(self):
+        return np.array([0., 0., 1.]), self.context.half_fov
 
-    def upload_intrinsics(self):
-        glUniform1fv(self.context.shader_ids['distorsion_coeff'], 5, self.context.distorsion_coeffs)
-        glUniform2fv(self.context.shader_ids['center_off'], 1, self.context.center_off)
-        glUniform2fv(self.context.shader_ids['focal_dist'], 1, self.context.focal_dist)
-        glUniform1f(self.context.shader_ids['far'], self.context.far)
+    def update_uniforms(self):
+        uniforms = self.context.camera_uniforms
+        uniforms.set('distorsion_coeff', self.context.distorsion_coeffs)
+        uniforms.set('center_off', self.context.center_off)
+        uniforms.set('focal_dist', self.context.focal_dist)
+        uniforms.set('far', self.context.far)
 
 
 class PerspectiveModel(BaseCameraModel):
+    y_down = False
+
     def __init__(self, context, shader):
         super().__init__(context, shader, "perspective")
 
     def init_intrinsics(self, image_size, fov=45., far=20., near=0.05):
         width,height = image_size
-        self.context.Projection = glm.perspective(glm.radians(fov),float(width)/float(height),near,far)
-        self.locate_uniforms(['P'])
+        half_height = np.tan(np.deg2rad(fov) / 2)
+        # Same matrix as gluPerspective / glm.perspective
+        self.context.projection_matrix = np.array([[1 / (half_height * width / height), 0, 0, 0],
+                                                   [0, 1 / half_height, 0, 0],
+                                                   [0, 0, (far + near) / (near - far), 2 * far * near / (near - far)],
+                                                   [0, 0, -1, 0]])
+        if getattr(self.context, 'top_down', False):
+            self.context.projection_matrix[1] *= -1
+        self.context.far = far
+        self.context.half_fov = np.arctan(np.hypot(half_height, half_height * width / height))
+        self.context.pixel_angle = 2 * half_height / height
+        self.update_uniforms()
+
+    def get_view_cone(self):
+        return np.array([0., 0., -1.]), self.context.half_fov
 
-    def upload_intrinsics(self):
-        glUniformMatrix4fv(self.context.shader_ids['P'], 1, GL_FALSE, glm.value_ptr(self.context.Projection))
+    def update_uniforms(self):
+        self.context.camera_uniforms.set('P', self.context.projection_matrix)
 
 
-camera_models = {'ocam': OcamModel, 'opencv': OpenCVModel, 'perspective': PerspectiveModel}
-vertex_shader_models = {'ocam': 'vertex_ocam.glsl', 'opencv': 'vertex_opencv.glsl',
+camera_models = {'ocam': OcamModel, 'ocam_fast': OcamFastModel, 'opencv': OpenCVModel,
+                 'perspective': PerspectiveModel}
+vertex_shader_models = {'ocam': 'vertex_ocam.glsl', 'ocam_fast': 'vertex_ocam_fast.glsl', 'opencv': 'vertex_opencv.glsl',
                         'perspective': 'vertex_perspective.glsl'}
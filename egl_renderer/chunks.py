@@ -0,0 +1,96 @@
+import numpy as np
+
+
+def _spread_bits(x):
+    # Interleave the lower 21 bits of x with two zero bits (for 3D Morton codes)
+    x = x.astype(np.uint64) & np.uint64(0x1fffff)
+    x = (x | (x << np.uint64(32))) & np.uint64(0x1f00000000ffff)
+    x = (x | (x << np.uint64(16))) & np.uint64(0x1f0000ff0000ff)
+    x = (x | (x << np.uint64(8))) & np.uint64(0x100f00f00f00f00f)
+    x = (x | (x << np.uint64(4))) & np.uint64(0x10c30c30c30c30c3)
+    x = (x | (x << np.uint64(2))) & np.uint64(0x1249249249249249)
+    return x
+
+
+def morton_codes(cells):
+    return _spread_bits(cells[:, 0]) | (_spread_bits(cells[:, 1]) << np.uint64(1)) | \
+           (_spread_bits(cells[:, 2]) << np.uint64(2))
+
+
+class PointChunks:
+    def __init__(self, vertices, chunk_size, lod_levels=0, lod_voxel_size=None):
+        vertices = np.asarray(vertices)
+        self.chunk_size = float(chunk_size)
+        self.origin = vertices.min(axis=0).astype(np.float64)
+        cells = np.floor((vertices - self.origin) / self.chunk_size).astype(np.int64)
+        codes = morton_codes(cells)
+        # Morton order keeps spatially close chunks close in the buffer, so visible chunks merge into longer ranges
+        self.order = np.argsort(codes, kind='stable')
+        sorted_codes = codes[self.order]
+        boundaries = np.flatnonzero(sorted_codes[1:] != sorted_codes[:-1]) + 1
+        self.first = np.concatenate([[0], boundaries]).astype(np.int32)
+        self.count = np.diff(np.concatenate([self.first, [len(vertices)]])).astype(np.int32)
+
+        sorted_verts = vertices[self.order]
+        self.bbox_min = np.minimum.reduceat(sorted_verts, self.first, axis=0).astype(np.float64)
+        self.bbox_max = np.maximum.reduceat(sorted_verts, self.first, axis=0).astype(np.float64)
+        self.centers = (self.bbox_min + self.bbox_max) / 2.
+        self.radii = np.linalg.norm(self.bbox_max - self.bbox_min, axis=1) / 2.
+
+        # Buffer position -> original point index; LOD levels append their representatives after the full cloud
+        self.vertex_order = self.order
+        self.level_first = [self.first]
+        self.level_count = [self.count]
+        self.voxel_sizes = np.zeros(1)
+        if lod_levels > 0:
+            self.build_lod(sorted_verts, lod_levels, lod_voxel_size or self.chunk_size / 64.)
+
+    def build_lod(self, sorted_verts, lod_levels, lod_voxel_size):
+        chunk_ids = np.repeat(np.arange(len(self.first)), self.count)
+        vertex_orders = [self.order]
+        offset = len(self.order)
+        for level in range(1, lod_levels + 1):
+            voxel_size = lod_voxel_size * 2 ** (level - 1)
+            # Voxels are aligned to the chunk bounding box, so their coordinates inside a chunk are bounded
+            voxel_dim = int(np.ceil(self.chunk_size / voxel_size)) + 1
+            voxels = np.floor((sorted_verts - self.bbox_min[chunk_ids]) / voxel_size).astype(np.int64)
+            keys = ((chunk_ids * voxel_dim + voxels[:, 0]) * voxel_dim + voxels[:, 1]) * voxel_dim + voxels[:, 2]
+            # The first point of each voxel represents it; unique keys are sorted, so chunks stay grouped
+            _, representatives = np.unique(keys, return_index=True)
+            level_count = np.bincount(chunk_ids[representatives], minlength=len(self.first)).astype(np.int32)
+            level_first = offset + np.concatenate([[0], np.cumsum(level_count)[:-1]])
+            self.level_first.append(level_first.astype(np.int32))
+            self.level_count.append(level_count)
+            vertex_orders.append(self.order[representatives])
+            offset += len(representatives)
+        self.voxel_sizes = np.concatenate([[0.], lod_voxel_size * 2. ** np.arange(lod_levels)])
+        self.vertex_order = np.concatenate(vertex_orders)
+
+    def __len__(self):
+        return len(self.first)
+
+    def select_levels(self, camera_position, pixel_angle, max_error):
+        # Coarsest level whose voxels project to at most max_error pixels at the nearest point of the chunk
+        dists = np.maximum(np.linalg.norm(self.centers - camera_position, axis=1) - self.radii, 1e-6)
+        allowed_size = max_error * pixel_angle * dists
+        return np.searchsorted(self.voxel_sizes, allowed_size, side='right') - 1
+
+    @staticmethod
+    def get_runs(mask, chunk_first, chunk_count):
+        mask = np.asarray(mask, dtype=np.int8)
+        if not mask.any():
+            return np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.int32)
+        edges = np.diff(np.concatenate([[0], mask, [0]]))
+        run_starts = np.flatnonzero(edges == 1)
+        run_ends = np.flatnonzero(edges == -1)
+        first = chunk_first[run_starts]
+        last = chunk_first[run_ends - 1] + chunk_count[run_ends - 1]
+        return first, (last - first).astype(np.int32)
+
+    def visible_ranges(self, mask, levels=None):
+        # Neighbouring chunks are contiguous in the buffer, so runs of visible chunks are drawn as one range
+        if levels is None:
+            return self.get_runs(mask, self.first, self.count)
+        ranges = [self.get_runs(mask & (levels == level), self.level_first[level], self.level_count[level])
+                  for level in range(len(self.level_first))]
+        return np.concatenate([x[0] for x in ranges]), np.concatenate([x[1] for x in ranges])
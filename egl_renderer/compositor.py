@@ -0,0 +1,131 @@
+import os
+import numpy as np
+from OpenGL.GL import *
+from .shader_loader import Shader
+
+
+class VideoCompositor:
+    # Draws decoded video frames into the bound framebuffer on top of the render.
+    # Layouts: 'left'/'right' show the video left/right of the wipe position `split` (fraction of the width),
+    # 'pip' shows the whole video scaled into pip_rect (x, y, width, height as fractions, from the top left).
+    # rows_top_first tells whether framebuffer row 0 holds the top image row, otherwise the video is mirrored to match
+    layouts = ['left', 'right', 'pip']
+
+    def __init__(self, width, height, layout='left', split=0.5, pip_rect=(0.65, 0.05, 0.3, 0.3), alpha=1.,
+                 upload_buffers=2, rows_top_first=True):
+        if layout not in self.layouts:
+            raise ValueError("Unknown layout '{}', available: {}".format(layout, ", ".join(self.layouts)))
+        self.width, self.height = width, height
+        self.layout = layout
+        self.split = split
+        self.pip_rect = pip_rect
+        self.alpha = alpha
+        self.rows_top_first = rows_top_first
+
+        self.shader = Shader()
+        dirname = os.path.dirname(os.path.abspath(__file__))
+        self.shader.initShaderFromGLSL([os.path.join(dirname, "shaders/vertex_composite.glsl")],
+                                       [os.path.join(dirname, "shaders/fragment_composite.glsl")])
+        self.src_rect_id = glGetUniformLocation(self.shader.program, 'src_rect')
+        self.shader.begin()
+        glUniform1i(glGetUniformLocation(self.shader.program, 'video'), 0)
+        self.shader.end()
+        # The quad has no attributes, but core profiles still require a bound VAO
+        self.vao = glGenVertexArrays(1)
+
+        self.texture = glGenTextures(1)
+        self.texture_dims = (None, None)
+        self.upload_pbos = [int(x) for x in np.atleast_1d(glGenBuffers(upload_buffers))]
+        self.upload_ind = 0
+
+    def _configure_texture(self, frame_width, frame_height):
+        glBindTexture(GL_TEXTURE_2D, self.texture)
+        if self.texture_dims != (frame_width, frame_height):
+            glTexImage2D(GL_TEXTURE_2D, 0, GL_RGB8, frame_width, frame_height, 0, GL_RGB, GL_UNSIGNED_BYTE, None)
+            # Split layouts copy the video 1:1 when the sizes match, only the inset is resampled
+            tex_filter = GL_LINEAR if self.layout == 'pip' or (frame_width, frame_height) != \
+                (self.width, self.height) else GL_NEAREST
+            glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, tex_filter)
+            glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, tex_filter)
+            glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_WRAP_S, GL_CLAMP_TO_EDGE)
+            glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_WRAP_T, GL_CLAMP_TO_EDGE)
+            self.texture_dims = (frame_width, frame_height)
+
+    def upload(self, frame):
+        # The frame goes through a PBO, alternating between buffers so the copy into the texture
+        # does not stall on the previous frame's transfer
+        frame = np.ascontiguousarray(frame, dtype=np.uint8)
+        frame_height, frame_width = frame.shape[:2]
+        self._configure_texture(frame_width, frame_height)
+        pbo = self.upload_pbos[self.upload_ind]
+        self.upload_ind = (self.upload_ind + 1) % len(self.upload_pbos)
+        glBindBuffer(GL_PIXEL_UNPACK_BUFFER, pbo)
+        # Orphaning the storage lets the driver hand out fresh memory if the old one is still in use
+        glBufferData(GL_PIXEL_UNPACK_BUFFER, frame.nbytes, None, GL_STREAM_DRAW)
+        glBufferSubData(GL_PIXEL_UNPACK_BUFFER, 0, frame.nbytes, frame)
+        glPixelStorei(GL_UNPACK_ALIGNMENT, 1)
+        glTexSubImage2D(GL_TEXTURE_2D, 0, 0, 0, frame_width, frame_height, GL_RGB, GL_UNSIGNED_BYTE, None)
+        glBindBuffer(GL_PIXEL_UNPACK_BUFFER, 0)
+        glBindTexture(GL_TEXTURE_2D, 0)
+
+    def get_rects(self):
+        # Destination pixel rectangle (x, y, width, height) and source texture rectangle (s0, t0, s1, t1);
+        # video rows are stored top first in the texture
+        if self.layout == 'pip':
+            x, y, w, h = self.pip_rect
+            dst = [int(round(x * self.width)), int(round(y * self.height)),
+                   int(round(w * self.width)), int(round(h * self.height))]
+            src = [0., 0., 1., 1.]
+        else:
+            split_x = int(self.split * self.width)
+            if self.layout == 'left':
+                x0, x1 = 0, split_x
+            else:
+                x0, x1 = split_x, self.width
+            dst, src = [x0, 0, x1 - x0, self.height], [x0 / self.width, 0., x1 / self.width, 1.]
+        if not self.rows_top_first:
+            # Bottom-up framebuffer: the rectangle is mirrored vertically and the texture is sampled upwards
+            dst[1] = self.height - dst[1] - dst[3]
+            src[1], src[3] = src[3], src[1]
+        return dst, tuple(src)
+
+    def get_render_region(self):
+        # Part of the frame where the render stays visible, as (x, y, width, height), or None for the whole frame
+        if self.layout == 'pip' or self.alpha < 1:
+            return None
+        (x, _, w, _), _ = self.get_rects()
+        if x == 0:
+            return [w, 0, self.width - w, self.height]
+        return [0, 0, x, self.height]
+
+    def draw(self, frame=None):
+        if frame is not None:
+            self.upload(frame)
+        dst, src = self.get_rects()
+        if dst[2] <= 0 or dst[3] <= 0:
+            return
+        glDisable(GL_DEPTH_TEST)
+        if self.alpha < 1:
+            glEnable(GL_BLEND)
+            glBlendColor(0., 0., 0., self.alpha)
+            glBlendFunc(GL_CONSTANT_ALPHA, GL_ONE_MINUS_CONSTANT_ALPHA)
+        glViewport(*dst)
+        self.shader.begin()
+        glUniform4f(self.src_rect_id, *src)
+        glActiveTexture(GL_TEXTURE0)
+        glBindTexture(GL_TEXTURE_2D, self.texture)
+        glBindVertexArray(self.vao)
+        glDrawArrays(GL_TRIANGLE_STRIP, 0, 4)
+        glBindVertexArray(0)
+        glBindTexture(GL_TEXTURE_2D, 0)
+        self.shader.end()
+        glViewport(0, 0, self.width, self.height)
+        if self.alpha < 1:
+            glDisable(GL_BLEND)
+        glEnable(GL_DEPTH_TEST)
+
+    def release(self):
+        glDeleteBuffers(len(self.upload_pbos), self.upload_pbos)
+        glDeleteTextures([self.texture])
+        glDeleteVertexArrays(1, [self.vao])
+        glDeleteProgram(self.shader.program)
@@ -0,0 +1,133 @@
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from .camera import get_view_matrices
+
+
+class CPUPointCloudRenderer:
+    # NumPy reference implementation of PointCloudRenderer for the opencv camera model: points are projected
+    # like in vertex_opencv.glsl, splatted with the size rule of geometry.glsl and resolved with a sorted z-buffer.
+    # Buffers are kept in GL row order, so get_image returns the same arrays as the GL renderer
+    depth_bits = 24
+
+    def __init__(self, width, height, threads=1, tiles=None):
+        self.viewport_width = width
+        self.viewport_height = height
+        self.threads = threads
+        # Horizontal bands of the frame rasterized independently, they bound the memory of the fragment arrays
+        self.tiles = max(threads, 1) if tiles is None else tiles
+
+    def init_opengl(self):
+        # Nothing to set up, kept for interface compatibility
+        pass
+
+    def init_context(self, pointcloud, camera_mode, top_down=False, **camera_params):
+        if camera_mode != 'opencv':
+            raise ValueError("CPU renderer supports only the opencv camera model, got '{}'".format(camera_mode))
+        self.camera_mode = camera_mode
+        self.top_down = top_down
+        self.vertices = np.ascontiguousarray(pointcloud.vertices, dtype=np.float32)
+        self.colors = np.ascontiguousarray(pointcloud.colors[:, :3], dtype=np.uint8)
+        self.init_intrinsics(**camera_params)
+        self.view_matrix = np.eye(4, dtype=np.float32)
+        self.clear()
+
+    def init_intrinsics(self, image_size, focal_dist, center, distorsion_coeffs, far=20.):
+        # Same values as OpenCVModel sends to the shader
+        assert len(distorsion_coeffs) == 5
+        image_size = np.array(image_size)
+        self.focal_dist = (np.array(focal_dist) / image_size * 2).astype(np.float32)
+        self.center_off = (np.array(center) / image_size * 2 - 1).astype(np.float32)
+        self.distorsion_coeffs = np.array(distorsion_coeffs).astype(np.float32)
+        self.far = np.float32(far)
+
+    def locate_camera(self, quat, pose):
+        self.set_view_matrix(get_view_matrices(np.asarray(quat)[None], np.asarray(pose)[None])[0])
+
+    def set_view_matrix(self, view_matrix):
+        self.view_matrix = np.asarray(view_matrix, dtype=np.float32)
+
+    def clear(self):
+        height, width = self.viewport_height, self.viewport_width
+        self.color_buffer = np.full((height, width, 3), 255, dtype=np.uint8)
+        self.id_buffer = np.full((height, width), -1, dtype=np.int32)
+        self.depth_buffer = np.full((height, width), 2 ** self.depth_bits - 1, dtype=np.int64)
+
+    def project(self):
+        # Window coordinates of the splat rectangles and the quantized depth of every point, float32 like the shaders
+        mv = np.matmul(self.vertices, self.view_matrix[:3, :3].T) + self.view_matrix[:3, 3]
+        z = mv[:, 2]
+        # The shader takes the length of the homogeneous position, w=1 included
+        dist = np.sqrt((mv * mv).sum(axis=1) + 1)
+        # Outside of [-1, 1] in NDC depth: behind the camera or farther than far
+        valid = (z > 0) & (dist <= self.far)
+        xy1 = mv[:, :2] / np.where(z == 0, np.float32(1), z)[:, None]
+        radius_sq = (xy1 * xy1).sum(axis=1)
+        radius_quad = radius_sq * radius_sq
+        k = self.distorsion_coeffs
+        radial = 1 + k[0] * radius_sq + k[1] * radius_quad + k[4] * radius_quad * radius_sq
+        tangential = np.stack([2 * k[2] * xy1[:, 0] * xy1[:, 1] + k[3] * (radius_sq + 2 * xy1[:, 0] * xy1[:, 0]),
+                               k[2] * (radius_sq + 2 * xy1[:, 1] * xy1[:, 1]) + 2 * k[3] * xy1[:, 0] * xy1[:, 1]],
+                              axis=1)
+        res = self.focal_dist * (xy1 * radial[:, None] + tangential) + self.center_off
+        half_size = np.float32(0.01) / (1 + np.float32(0.2) * np.abs(z))
+        window_size = np.array([self.viewport_width, self.viewport_height], dtype=np.float32) / 2
+        lower = (res - half_size[:, None] + 1) * window_size
+        upper = (res + half_size[:, None] + 1) * window_size
+        # Pixels whose centers lie in [lower, upper); far off-screen and invalid points are clamped before the cast
+        limit = window_size * 2 + 1
+        first = np.ceil(np.clip(np.nan_to_num(lower - 0.5, nan=-1.), -1, limit)).astype(np.int64)
+        last = np.ceil(np.clip(np.nan_to_num(upper - 0.5, nan=-1.), -1, limit)).astype(np.int64)
+        ndc_depth = dist / self.far * 2 - 1
+        depth = np.rint((ndc_depth + 1) / 2 * np.float32(2 ** self.depth_bits - 1)).astype(np.int64)
+        return first, last, depth, valid
+
+    def _rasterize_tile(self, row_start, row_end, first, last, depth, valid):
+        width = self.viewport_width
+        cols = np.clip(np.stack([first[:, 0], last[:, 0]], axis=1), 0, width)
+        rows = np.clip(np.stack([first[:, 1], last[:, 1]], axis=1), row_start, row_end)
+        ncols, nrows = cols[:, 1] - cols[:, 0], rows[:, 1] - rows[:, 0]
+        inds = np.flatnonzero(valid & (ncols > 0) & (nrows > 0))
+        if len(inds) == 0:
+            return
+        ncols, counts = ncols[inds], ncols[inds] * nrows[inds]
+        # Every fragment of every splat, expanded without a python loop
+        frag_inds = np.repeat(inds, counts)
+        frag_offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        frag_ncols = np.repeat(ncols, counts)
+        pixels = (rows[frag_inds, 0] + frag_offsets // frag_ncols) * width + cols[frag_inds, 0] + \
+            frag_offsets % frag_ncols
+        # Nearest fragment per pixel, ties go to the lower point index
+        order = np.lexsort((frag_inds, depth[frag_inds], pixels))
+        pixels, frag_inds = pixels[order], frag_inds[order]
+        nearest = np.ones(len(pixels), dtype=bool)
+        nearest[1:] = pixels[1:] != pixels[:-1]
+        pixels, frag_inds = pixels[nearest], frag_inds[nearest]
+        frag_depth = depth[frag_inds]
+        closer = frag_depth < self.depth_buffer.reshape(-1)[pixels]
+        pixels, frag_inds = pixels[closer], frag_inds[closer]
+        self.depth_buffer.reshape(-1)[pixels] = frag_depth[closer]
+        self.id_buffer.reshape(-1)[pixels] = frag_inds
+        self.color_buffer.reshape(-1, 3)[pixels] = self.colors[frag_inds]
+
+    def draw(self):
+        self.clear()
+        first, last, depth, valid = self.project()
+        bounds = np.linspace(0, self.viewport_height, self.tiles + 1).round().astype(int)
+        tiles = [(int(start), int(end)) for start, end in zip(bounds[:-1], bounds[1:]) if end > start]
+        if self.threads > 1 and len(tiles) > 1:
+            # Tiles write disjoint rows of the buffers, NumPy releases the GIL in the heavy parts
+            with ThreadPoolExecutor(self.threads) as executor:
+                list(executor.map(lambda tile: self._rasterize_tile(*tile, first, last, depth, valid), tiles))
+        else:
+            for tile in tiles:
+                self._rasterize_tile(*tile, first, last, depth, valid)
+
+    def _flip_rows(self, image):
+        return image if self.top_down else image[::-1]
+
+    def get_image(self):
+        return self._flip_rows(self.color_buffer), self._flip_rows(self.id_buffer)
+
+    def get_image_depth(self):
+        depth = (self.depth_buffer / (2 ** self.depth_bits - 1)).astype(np.float32)
+        return self._flip_rows(self.color_buffer), self._flip_rows(depth)
@@ -0,0 +1,42 @@
+import numpy as np
+
+
+class FrameReuse:
+    # Tells whether a frame renders the same image as the last rendered one: poses are quantized with the
+    # tolerances and keyed together with the camera parameters; zero tolerances match exactly equal poses only
+    def __init__(self, camera_params, position_tolerance=0., angle_tolerance=0.):
+        self.camera_key = np.asarray(camera_params, dtype=np.float64).tobytes()
+        self.position_tolerance = position_tolerance
+        # Rotating by an angle changes the quaternion components by at most sin(angle/2)
+        self.quaternion_tolerance = np.sin(angle_tolerance / 2)
+        self.last_key = None
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _quantize(values, tolerance):
+        if tolerance > 0:
+            values = np.floor(values / tolerance + 0.5)
+        # -0. and 0. must give the same key
+        return values + 0.
+
+    def get_key(self, quaternion, position):
+        quaternion = np.asarray(quaternion, dtype=np.float64)
+        # q and -q are the same rotation
+        if quaternion[0] < 0:
+            quaternion = -quaternion
+        return self.camera_key + self._quantize(quaternion, self.quaternion_tolerance).tobytes() + \
+            self._quantize(np.asarray(position, dtype=np.float64), self.position_tolerance).tobytes()
+
+    def check(self, quaternion, position):
+        # True if the last rendered frame can be reused, otherwise the pose becomes the new reference
+        key = self.get_key(quaternion, position)
+        if key == self.last_key:
+            self.hits += 1
+            return True
+        self.last_key = key
+        self.misses += 1
+        return False
+
+    def reset(self):
+        self.last_key = None
@@ -69,6 +69,8 @@ define_egl_ext_function('eglQueryDeviceStringEXT', ctypes.c_char_p)
 
 EGL_PLATFORM_DEVICE_EXT = 0x313F
 EGL_DRM_DEVICE_FILE_EXT = 0x3233
+EGL_DRM_RENDER_NODE_FILE_EXT = 0x3377
+EGL_PLATFORM_SURFACELESS_MESA = 0x31DD
 
 # utility function for egl attributes management
 def egl_convert_to_int_array(dict_attrs):
@@ -30,6 +30,7 @@
 # OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
+import os
 import OpenGL.EGL as egl
 from ctypes import pointer
 from . import devices, egl_convert_to_int_array
@@ -37,15 +38,22 @@ from .tools import TransactionMixin
 import logging
 
 class EGLContext(TransactionMixin):
-    def initialize(self, width, height):
-        for device in devices.probe():
-            if not self.initialize_on_device(device, width, height):
+    def initialize(self, width, height, device=None, surfaceless=False):
+        # device: index in the probed list or DRM device path, defaults to the EGL_RENDERER_DEVICE variable
+        if device is None:
+            device = os.environ.get('EGL_RENDERER_DEVICE') or None
+        probed_devices = devices.probe() if device is None else devices.select(device)
+        if len(probed_devices) == 0:
+            logging.error("No EGL device matches '{}'".format(device))
+        for egl_device in probed_devices:
+            if not self.initialize_on_device(egl_device, width, height, surfaceless):
+                logging.info("Failed to initialize OpenGL context on " + egl_device.name)
                 continue
+            print("selected: " + egl_device.name)
             return True
         logging.error("Failed to initialize OpenGL context.")
         return False
-    def initialize_on_device(self, device, width, height):
-        print("selected: " + device.name)
+    def initialize_on_device(self, device, width, height, surfaceless=False):
         # step 1
         if device.initialize():
             self.add_rollback_cb(lambda: device.release())
@@ -62,16 +70,23 @@ class EGLContext(TransactionMixin):
         if not egl.eglInitialize(egl_dpy, pointer(major), pointer(minor)):
             self.rollback(); return False
         logging.info("EGL version %d.%d" % (major.value, minor.value))
+        # Rendering goes to the renderer's own framebuffers, so no surface is needed if the display allows it
+        surfaceless_supported = self.supports_surfaceless(egl_dpy)
+        if getattr(device, 'requires_surfaceless', False) and not surfaceless_supported:
+            self.rollback(); return False
+        self.surfaceless = surfaceless_supported and (surfaceless or getattr(device, 'requires_surfaceless', False))
         # step 4
-        egl_config = self.get_config(egl_dpy, device.compatible_surface_type())
+        egl_config = self.get_config(egl_dpy, 0 if self.surfaceless else device.compatible_surface_type())
         if egl_config is None:
             self.rollback(); return False
         # step 5
-        egl_surface = device.create_surface(egl_dpy, egl_config)
-        if egl_surface.initialize(width, height):
-            self.add_rollback_cb(lambda: egl_surface.release())
-        else:
-            self.rollback(); return False
+        egl_surface = None
+        if not self.surfaceless:
+            egl_surface = device.create_surface(egl_dpy, egl_config)
+            if egl_surface.initialize(width, height):
+                self.add_rollback_cb(lambda: egl_surface.release())
+            else:
+                self.rollback(); return False
         # step 6
         egl_context = self.get_context(egl_dpy, egl_config)
         if egl_context is not None:
@@ -79,10 +94,18 @@ class EGLContext(TransactionMixin):
         else:
             self.rollback(); return False
         # step 7
-        if not egl_surface.make_current(egl_context):
+        if egl_surface is None:
+            made_current = egl.eglMakeCurrent(egl_dpy, egl.EGL_NO_SURFACE, egl.EGL_NO_SURFACE, egl_context)
+        else:
+            made_current = egl_surface.make_current(egl_context)
+        if not made_current:
             self.rollback(); return False
         # device seems to be working
         return True
+    @staticmethod
+    def supports_surfaceless(egl_dpy):
+        extensions = egl.eglQueryString(egl_dpy, egl.EGL_EXTENSIONS)
+        return extensions is not None and b'EGL_KHR_surfaceless_context' in extensions.split()
     def get_config(self, egl_dpy, surface_type):
         egl_config_attribs = {
             egl.EGL_RED_SIZE:           8,
@@ -28,10 +28,33 @@
 # OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
+import os
 from .generic import GenericEGLDevice
 from .gbm import GBMDevice
+from .surfaceless import SurfacelessDevice
 
-def probe():
-    for cls in (GenericEGLDevice, GBMDevice):
-        for device in cls.probe():
-            yield device
+_probed_devices = None
+
+def probe(refresh=False):
+    # Enumeration is done once per process, later contexts reuse the list
+    global _probed_devices
+    if _probed_devices is None or refresh:
+        _probed_devices = [device for cls in (GenericEGLDevice, GBMDevice) for device in cls.probe()]
+        if len(_probed_devices) == 0:
+            # No enumerable devices, the Mesa surfaceless platform still picks a GPU or the software rasterizer
+            _probed_devices = SurfacelessDevice.probe()
+    return _probed_devices
+
+def select(selector):
+    # Selector is either an index in the probed list or a DRM device path (card or render node)
+    probed_devices = probe()
+    if isinstance(selector, str) and selector.lstrip('-').isdigit():
+        selector = int(selector)
+    if isinstance(selector, int):
+        if not 0 <= selector < len(probed_devices):
+            available = ", ".join("{}: {}".format(ind, device.name) for ind, device in enumerate(probed_devices))
+            raise ValueError("EGL device index {} is out of range, available devices: {}".format(
+                selector, available or "none"))
+        return probed_devices[selector:selector + 1]
+    path = os.path.realpath(selector)
+    return [device for device in probed_devices if path in [os.path.realpath(x) for x in device.dev_paths]]
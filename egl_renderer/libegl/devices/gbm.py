@@ -73,6 +73,7 @@ class GBMDevice:
         return [ GBMDevice(card) for card in cards ]
     def __init__(self, dev_path):
         self.dev_path = dev_path
+        self.dev_paths = [dev_path]
         self.name = "GBM device " + dev_path
     def initialize(self):
         self.gbm_fd = os.open(self.dev_path, os.O_RDWR|os.O_CLOEXEC)
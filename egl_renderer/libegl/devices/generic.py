@@ -33,7 +33,7 @@
 # Modified by Vladimir Guzov, 2021
 
 import OpenGL.EGL as egl
-from .. import EGL_PLATFORM_DEVICE_EXT, EGL_DRM_DEVICE_FILE_EXT, egl_convert_to_int_array
+from .. import EGL_PLATFORM_DEVICE_EXT, EGL_DRM_DEVICE_FILE_EXT, EGL_DRM_RENDER_NODE_FILE_EXT, egl_convert_to_int_array
 from ctypes import pointer
 
 class GenericEGLSurface:
@@ -85,5 +85,15 @@ class GenericEGLDevice:
         if devstr is None:
             return "<unknown EGL device>"
         return "EGL device " + devstr.decode('ASCII')
+    @property
+    def dev_paths(self):
+        if not hasattr(egl, 'eglQueryDeviceStringEXT'):
+            return []
+        paths = []
+        for attrib in (EGL_DRM_DEVICE_FILE_EXT, EGL_DRM_RENDER_NODE_FILE_EXT):
+            devstr = egl.eglQueryDeviceStringEXT(self.egl_dev, attrib)
+            if devstr is not None:
+                paths.append(devstr.decode('ASCII'))
+        return paths
     def create_surface(self, egl_dpy, egl_config):
         return GenericEGLSurface(egl_dpy, egl_config)
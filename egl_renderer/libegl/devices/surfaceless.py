@@ -0,0 +1,25 @@
+import OpenGL.EGL as egl
+from .. import EGL_PLATFORM_SURFACELESS_MESA
+
+class SurfacelessDevice:
+    name = "Mesa surfaceless platform"
+    dev_paths = []
+    requires_surfaceless = True
+    @staticmethod
+    def probe():
+        if not hasattr(egl, 'eglGetPlatformDisplayEXT'):
+            return []
+        client_extensions = egl.eglQueryString(egl.EGL_NO_DISPLAY, egl.EGL_EXTENSIONS)
+        if client_extensions is None or b'EGL_MESA_platform_surfaceless' not in client_extensions.split():
+            return []
+        return [ SurfacelessDevice() ]
+    def get_egl_display(self):
+        return egl.eglGetPlatformDisplayEXT(EGL_PLATFORM_SURFACELESS_MESA, None, None)
+    def initialize(self):
+        return True
+    def release(self):
+        pass
+    def compatible_surface_type(self):
+        return 0
+    def create_surface(self, egl_dpy, egl_config):
+        return None
@@ -0,0 +1,127 @@
+import ctypes
+import numpy as np
+from collections import deque
+from OpenGL.GL import *
+
+
+class PBORing:
+    def __init__(self, shape, dtype=np.uint8, depth=3, persistent=True, flip_rows=True):
+        self.shape = tuple(shape)
+        # GL rows go bottom to top; without flip_rows the data is returned in memory order, C-contiguous
+        self.flip_rows = flip_rows
+        self.dtype = np.dtype(dtype)
+        self.nbytes = int(np.prod(self.shape)) * self.dtype.itemsize
+        self.depth = depth
+        self.persistent = persistent and bool(glBufferStorage)
+        self.pbos = [int(x) for x in np.atleast_1d(glGenBuffers(depth))]
+        self.mapped = [None] * depth
+        self.fences = [None] * depth
+        for ind, pbo in enumerate(self.pbos):
+            glBindBuffer(GL_PIXEL_PACK_BUFFER, pbo)
+            if self.persistent:
+                flags = GL_MAP_READ_BIT | GL_MAP_PERSISTENT_BIT | GL_MAP_COHERENT_BIT
+                glBufferStorage(GL_PIXEL_PACK_BUFFER, self.nbytes, None, flags)
+                self.mapped[ind] = self._as_array(glMapBufferRange(GL_PIXEL_PACK_BUFFER, 0, self.nbytes, flags))
+            else:
+                glBufferData(GL_PIXEL_PACK_BUFFER, self.nbytes, None, GL_STREAM_READ)
+        glBindBuffer(GL_PIXEL_PACK_BUFFER, 0)
+        self.free_slots = deque(range(depth))
+        self.entries = deque()
+
+    def _as_array(self, address):
+        buf = (ctypes.c_uint8 * self.nbytes).from_address(address)
+        return np.frombuffer(buf, self.dtype).reshape(self.shape)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def full(self):
+        return len(self.free_slots) == 0
+
+    def push(self, tag=None, read_fn=None):
+        # Entries without read_fn keep their place in the queue but do not occupy a PBO
+        slot = None
+        if read_fn is not None:
+            if self.full():
+                raise RuntimeError("All {} PBOs of the ring are pending, pop a frame first".format(self.depth))
+            slot = self.free_slots.popleft()
+            glBindBuffer(GL_PIXEL_PACK_BUFFER, self.pbos[slot])
+            read_fn()
+            glBindBuffer(GL_PIXEL_PACK_BUFFER, 0)
+            self.fences[slot] = glFenceSync(GL_SYNC_GPU_COMMANDS_COMPLETE, 0)
+        self.entries.append((tag, slot))
+
+    def pop(self, out=None):
+        # Returns the oldest entry's tag and data; without `out`, the data of the persistent path is
+        # a view of the mapped memory that stays valid until the slot is reused by a later push
+        tag, slot = self.entries.popleft()
+        if slot is None:
+            return tag, None
+        glClientWaitSync(self.fences[slot], GL_SYNC_FLUSH_COMMANDS_BIT, GL_TIMEOUT_IGNORED)
+        glDeleteSync(self.fences[slot])
+        self.fences[slot] = None
+        self.free_slots.append(slot)
+        if self.persistent:
+            data = self.mapped[slot][::-1] if self.flip_rows else self.mapped[slot]
+            if out is None:
+                return tag, data
+            np.copyto(out, data)
+            return tag, out
+        if out is None:
+            out = np.empty(self.shape, self.dtype)
+        glBindBuffer(GL_PIXEL_PACK_BUFFER, self.pbos[slot])
+        address = glMapBufferRange(GL_PIXEL_PACK_BUFFER, 0, self.nbytes, GL_MAP_READ_BIT)
+        data = self._as_array(address)
+        np.copyto(out, data[::-1] if self.flip_rows else data)
+        glUnmapBuffer(GL_PIXEL_PACK_BUFFER)
+        glBindBuffer(GL_PIXEL_PACK_BUFFER, 0)
+        return tag, out
+
+    def release(self):
+        for ind, pbo in enumerate(self.pbos):
+            if self.fences[ind] is not None:
+                glDeleteSync(self.fences[ind])
+            if self.persistent:
+                glBindBuffer(GL_PIXEL_PACK_BUFFER, pbo)
+                glUnmapBuffer(GL_PIXEL_PACK_BUFFER)
+        glBindBuffer(GL_PIXEL_PACK_BUFFER, 0)
+        glDeleteBuffers(len(self.pbos), self.pbos)
+        self.pbos = []
+        self.mapped = []
+        self.entries.clear()
+
+
+class PBOBundleRing:
+    # PBO rings of several attachments advanced together, pop() returns the data of one frame from all of them
+    def __init__(self, attachments, depth=3, persistent=True, flip_rows=True):
+        # attachments: {name: (shape, dtype)}
+        self.rings = {name: PBORing(shape, dtype, depth, persistent, flip_rows)
+                      for name, (shape, dtype) in attachments.items()}
+
+    def __len__(self):
+        return len(next(iter(self.rings.values())))
+
+    def full(self):
+        return any(ring.full() for ring in self.rings.values())
+
+    def push(self, tag=None, read_fns=None):
+        # read_fns maps attachment names to their read functions; without it the entry carries only the tag
+        if read_fns is not None and self.full():
+            raise RuntimeError("All PBOs of the ring are pending, pop a frame first")
+        for name, ring in self.rings.items():
+            ring.push(tag, None if read_fns is None else read_fns[name])
+
+    def pop(self, out=None):
+        # Returns the oldest entry's tag and a {name: data} bundle, or None for entries without reads;
+        # `out` may hold preallocated arrays for some of the attachments
+        bundle = {}
+        for name, ring in self.rings.items():
+            tag, bundle[name] = ring.pop(None if out is None else out.get(name))
+        if all(x is None for x in bundle.values()):
+            return tag, None
+        return tag, bundle
+
+    def release(self):
+        for ring in self.rings.values():
+            ring.release()
+        self.rings = {}
@@ -0,0 +1,142 @@
+import time
+import queue
+import threading
+
+_end = object()
+
+
+class _StageError:
+    def __init__(self, error):
+        self.error = error
+
+
+class StageQueue:
+    # Bounded queue between two pipeline stages; records how full it is when items are taken
+    # and how long the producer (queue full) and the consumer (queue empty) were blocked
+    def __init__(self, name, maxsize):
+        self.name = name
+        self.maxsize = maxsize
+        self.queue = queue.Queue(maxsize)
+        self.put_stall = 0.
+        self.get_stall = 0.
+        self.occupancy_sum = 0
+        self.items = 0
+
+    def put(self, item):
+        start = time.perf_counter()
+        self.queue.put(item)
+        self.put_stall += time.perf_counter() - start
+
+    def get(self):
+        self.occupancy_sum += self.queue.qsize()
+        start = time.perf_counter()
+        item = self.queue.get()
+        self.get_stall += time.perf_counter() - start
+        if item is not _end and not isinstance(item, _StageError):
+            self.items += 1
+        return item
+
+    def get_stats(self):
+        return {'name': self.name, 'maxsize': self.maxsize, 'items': self.items,
+                'mean_occupancy': self.occupancy_sum / max(self.items, 1),
+                'producer_stall': self.put_stall, 'consumer_stall': self.get_stall}
+
+
+class PrefetchIterator:
+    # Runs an iterator on a background thread, e.g. video decoding; errors are raised in the consuming thread
+    def __init__(self, iterable, maxsize=8, name='prefetch'):
+        self.queue = StageQueue(name, maxsize)
+        self.stopped = threading.Event()
+        self.finished = False
+        self.thread = threading.Thread(target=self._run, args=(iter(iterable),), daemon=True)
+        self.thread.start()
+
+    def _run(self, iterator):
+        try:
+            for item in iterator:
+                if self.stopped.is_set():
+                    return
+                self.queue.put(item)
+        except BaseException as e:
+            self.queue.put(_StageError(e))
+            return
+        self.queue.put(_end)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.finished:
+            raise StopIteration
+        item = self.queue.get()
+        if item is _end:
+            self.finished = True
+            raise StopIteration
+        if isinstance(item, _StageError):
+            self.finished = True
+            raise item.error
+        return item
+
+    def close(self):
+        # Unblocks the producer if the consumer stops early
+        self.stopped.set()
+        while self.thread.is_alive():
+            try:
+                self.queue.queue.get(timeout=0.1)
+            except queue.Empty:
+                pass
+
+
+class ConsumerThread:
+    # Calls fn for every submitted item on a background thread, e.g. video encoding;
+    # an error in fn is raised by the next submit() or by close()
+    def __init__(self, fn, maxsize=4, name='consumer'):
+        self.fn = fn
+        self.queue = StageQueue(name, maxsize)
+        self.error = None
+        self.error_raised = False
+        self.busy_time = 0.
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is _end:
+                return
+            if self.error is not None:
+                # Keep draining, so the producer never blocks on a failed stage
+                continue
+            start = time.perf_counter()
+            try:
+                self.fn(item)
+            except BaseException as e:
+                self.error = e
+            self.busy_time += time.perf_counter() - start
+
+    def _raise_error(self):
+        if self.error is not None and not self.error_raised:
+            self.error_raised = True
+            raise self.error
+
+    def submit(self, item):
+        self._raise_error()
+        self.queue.put(item)
+
+    def close(self):
+        # Waits until all submitted items are processed
+        if self.thread.is_alive():
+            self.queue.put(_end)
+            self.thread.join()
+        self._raise_error()
+
+    def get_stats(self):
+        stats = self.queue.get_stats()
+        stats['busy'] = self.busy_time
+        return stats
+
+
+def format_stats(stats):
+    return "\n".join("{name}: {items} items, mean occupancy {mean_occupancy:.2f}/{maxsize}, "
+                     "producer stalled {producer_stall:.2f}s, consumer stalled {consumer_stall:.2f}s".format(**x) +
+                     (", busy {:.2f}s".format(x['busy']) if 'busy' in x else "") for x in stats)
@@ -0,0 +1,144 @@
+import os
+import json
+import tempfile
+import numpy as np
+from zipfile import ZipFile, ZIP_STORED
+from .utils import get_zip_entry_offset
+
+
+def load_npz_mmap(path):
+    # Members of an uncompressed .npz are mapped in place, so slicing reads only the touched pages
+    arrays = {}
+    with ZipFile(path) as npz:
+        infos = npz.infolist()
+    if any(info.compress_type != ZIP_STORED for info in infos):
+        with np.load(path) as npz:
+            return {k: npz[k] for k in npz.files}
+    with open(path, 'rb') as npz_file:
+        for info in infos:
+            npz_file.seek(get_zip_entry_offset(path, info))
+            version = np.lib.format.read_magic(npz_file)
+            if version == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(npz_file)
+            else:
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(npz_file)
+            name = info.filename[:-len('.npy')]
+            if len(shape) == 0 or np.prod(shape) == 0:
+                arrays[name] = np.fromfile(npz_file, dtype, count=int(np.prod(shape))).reshape(shape)
+                continue
+            arrays[name] = np.memmap(path, dtype, 'r', offset=npz_file.tell(), shape=shape,
+                                     order='F' if fortran_order else 'C')
+    return arrays
+
+
+class PoseTrack:
+    # Camera poses of consecutive frames starting at first_frame; frames without localization have valid=False
+    def __init__(self, first_frame, position, quaternion, valid):
+        self.first_frame = int(first_frame)
+        self.position = position
+        self.quaternion = quaternion
+        self.valid = valid
+
+    def __len__(self):
+        return len(self.valid)
+
+    @property
+    def last_frame(self):
+        return self.first_frame + len(self) - 1
+
+    @property
+    def frame_idx(self):
+        return np.arange(self.first_frame, self.first_frame + len(self))
+
+    @classmethod
+    def from_json(cls, path):
+        results = json.load(open(path))
+        frames = np.fromiter((int(k) for k in results.keys()), dtype=np.int64, count=len(results))
+        if len(frames) == 0:
+            return cls(0, np.zeros((0, 3)), np.zeros((0, 4)), np.zeros(0, dtype=bool))
+        first_frame = frames.min()
+        frames_count = frames.max() - first_frame + 1
+        position = np.zeros((frames_count, 3))
+        quaternion = np.zeros((frames_count, 4))
+        quaternion[:, 0] = 1.
+        valid = np.zeros(frames_count, dtype=bool)
+        poses = list(results.values())
+        located = np.array([x is not None for x in poses], dtype=bool)
+        if located.any():
+            rows = frames[located] - first_frame
+            position[rows] = [x['position'] for x in poses if x is not None]
+            quaternion[rows] = [x['quaternion'] for x in poses if x is not None]
+            valid[rows] = True
+        return cls(first_frame, position, quaternion, valid)
+
+    @staticmethod
+    def get_cache_path(path):
+        return path + '.npz'
+
+    @staticmethod
+    def get_source_stat(path):
+        stat = os.stat(path)
+        return np.array([stat.st_size, stat.st_mtime_ns], dtype=np.int64)
+
+    @classmethod
+    def load(cls, path, cache=True):
+        # Parses the localization JSON once and keeps the arrays in an .npz next to it
+        if not cache:
+            return cls.from_json(path)
+        cache_path = cls.get_cache_path(path)
+        if os.path.isfile(cache_path):
+            try:
+                arrays = load_npz_mmap(cache_path)
+                if np.array_equal(arrays['source_stat'], cls.get_source_stat(path)):
+                    return cls(int(arrays['first_frame']), arrays['position'], arrays['quaternion'],
+                               arrays['valid'])
+            except (OSError, ValueError, KeyError):
+                pass
+        track = cls.from_json(path)
+        try:
+            track.save(cache_path, cls.get_source_stat(path))
+        except OSError:
+            # Read-only location, the parsed track is still usable
+            pass
+        return track
+
+    def save(self, path, source_stat=None):
+        # Written to a temporary file first, so readers never see a partial cache
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), prefix='.tmp_', suffix='.npz')
+        try:
+            with os.fdopen(fd, 'wb') as output_file:
+                np.savez(output_file, first_frame=np.array(self.first_frame, dtype=np.int64),
+                         position=np.asarray(self.position, dtype=np.float64),
+                         quaternion=np.asarray(self.quaternion, dtype=np.float64),
+                         valid=np.asarray(self.valid, dtype=bool),
+                         source_stat=np.zeros(2, dtype=np.int64) if source_stat is None else source_stat)
+            os.replace(tmp_path, path)
+        except OSError:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def get_range(self, start_frame, end_frame):
+        # Frames start_frame..end_frame-1; views into the arrays, padded with invalid frames outside the track
+        start = start_frame - self.first_frame
+        stop = end_frame - self.first_frame
+        if start >= 0 and stop <= len(self):
+            return PoseTrack(start_frame, self.position[start:stop], self.quaternion[start:stop],
+                             self.valid[start:stop])
+        track = PoseTrack(start_frame, np.zeros((stop - start, 3)), np.zeros((stop - start, 4)),
+                          np.zeros(stop - start, dtype=bool))
+        track.quaternion[:, 0] = 1.
+        src_start, src_stop = max(start, 0), min(stop, len(self))
+        if src_start < src_stop:
+            dst = slice(src_start - start, src_stop - start)
+            track.position[dst] = self.position[src_start:src_stop]
+            track.quaternion[dst] = self.quaternion[src_start:src_stop]
+            track.valid[dst] = self.valid[src_start:src_stop]
+        return track
+
+    def get_pose(self, frame):
+        # (quaternion, position) of the frame or None if it was not localized
+        ind = frame - self.first_frame
+        if ind < 0 or ind >= len(self) or not self.valid[ind]:
+            return None
+        return self.quaternion[ind], self.position[ind]
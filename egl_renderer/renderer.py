@@ -3,7 +3,12 @@ import os
 import numpy as np
 from OpenGL.GL import *
 from .shader_loader import Shader
-from .camera import camera_models, vertex_shader_models
+from .camera import camera_models, vertex_shader_models, get_view_matrices
+from .pbo import PBORing, PBOBundleRing
+from .scene import PointCloudObject
+from .streaming import StreamingPointCloudObject
+from .compositor import VideoCompositor
+from .visibility import VisibilityAccumulator
 
 
 def form_cubes(verts, colors, cube_size=0.03):
@@ -36,12 +41,20 @@ class PointCloudRenderer:
     class GLContext(object):
         pass
 
+    # Attachments available for readback: read buffer, format, type, dtype and channels
+    readback_attachments = {'color': (GL_COLOR_ATTACHMENT0, GL_RGB, GL_UNSIGNED_BYTE, np.uint8, 3),
+                            'depth': (None, GL_DEPTH_COMPONENT, GL_FLOAT, np.float32, 1),
+                            'ids': (GL_COLOR_ATTACHMENT1, GL_RED_INTEGER, GL_INT, np.int32, 1)}
+
     def _delete_main_framebuffer(self):
         buf_list = [self._main_fb, self._main_cb, self._main_db]
         buf_list = [x for x in buf_list if x is not None]
         glDeleteFramebuffers(len(buf_list), buf_list)
+        if self._main_ib is not None:
+            glDeleteTextures([self._main_ib])
 
         self._main_fb = None
+        self._main_ib = None
         self._main_cb = None
         self._main_db = None
         self._main_fb_dims = (None, None)
@@ -58,13 +71,11 @@ class PointCloudRenderer:
             # Generate standard buffer
             self._main_cb, self._main_db = glGenRenderbuffers(2)
 
-            self._main_ib = glGenRenderbuffers(1)
-
-            glBindRenderbuffer(GL_RENDERBUFFER, self._main_ib)
-            glRenderbufferStorage(
-                GL_RENDERBUFFER, GL_R32I,
-                self.viewport_width, self.viewport_height
-            )
+            # Ids are kept in a texture, so compute shaders can read them as an image
+            self._main_ib = glGenTextures(1)
+            glBindTexture(GL_TEXTURE_2D, self._main_ib)
+            glTexStorage2D(GL_TEXTURE_2D, 1, GL_R32I, self.viewport_width, self.viewport_height)
+            glBindTexture(GL_TEXTURE_2D, 0)
 
             glBindRenderbuffer(GL_RENDERBUFFER, self._main_cb)
             glRenderbufferStorage(
@@ -88,9 +99,9 @@ class PointCloudRenderer:
                 GL_DRAW_FRAMEBUFFER, GL_DEPTH_ATTACHMENT,
                 GL_RENDERBUFFER, self._main_db
             )
-            glFramebufferRenderbuffer(
+            glFramebufferTexture2D(
                 GL_DRAW_FRAMEBUFFER, GL_COLOR_ATTACHMENT1,
-                GL_RENDERBUFFER, self._main_ib
+                GL_TEXTURE_2D, self._main_ib, 0
             )
 
             self._main_fb_dims = (self.viewport_width, self.viewport_height)
@@ -99,6 +110,14 @@ class PointCloudRenderer:
         self.viewport_width = width
         self.viewport_height = height
         self._main_fb = None
+        self.pbo_ring = None
+        self.readback_ring = None
+        self.visibility = None
+        self.compositor = None
+        self._batch_fb = None
+        self._indirect_buffer = None
+        self.render_region = None
+        self.read_region = None
 
     def __del__(self):
         pass
@@ -113,63 +132,169 @@ class PointCloudRenderer:
         glDepthMask(GL_TRUE)
         glDepthFunc(GL_LESS)
         glDepthRange(0.0, 1.0)
-
-    def init_context(self, pointcloud, camera_mode, **camera_params):
-        self.context = self.GLContext()
-
-        self.shader = shader = Shader()
+        glPixelStorei(GL_PACK_ALIGNMENT, 1)
+
+    def init_pbo_ring(self, depth=3):
+        if self.pbo_ring is not None:
+            self.pbo_ring.release()
+        _, _, width, height = self.get_read_region()
+        self.pbo_ring = PBORing((height, width, 3), np.uint8, depth, flip_rows=not self.top_down)
+
+    def init_compositor(self, layout='left', **layout_params):
+        if self.compositor is not None:
+            self.compositor.release()
+        # Called after init_context: the camera model and readback mode decide the framebuffer row order
+        self.compositor = VideoCompositor(self.viewport_width, self.viewport_height, layout,
+                                          rows_top_first=self.top_down or self.camera.y_down, **layout_params)
+
+    def composite_video(self, frame, rendered=True):
+        # Draws the video frame over the render in the main framebuffer, so only the composited frame is read back;
+        # frames that were not rendered get a black background
+        glBindFramebuffer(GL_DRAW_FRAMEBUFFER, self._main_fb)
+        if not rendered:
+            glClearBufferfv(GL_COLOR, 0, (0., 0., 0., 0.))
+            glClearBufferiv(GL_COLOR, 1, -1)
+        self.compositor.draw(frame)
+
+    def set_render_region(self, region=None, crop_readback=True):
+        # Restricts drawing to region = (x, y, width, height) in framebuffer pixels, like glViewport;
+        # with crop_readback the image readers return only the region. None renders the full frame again.
+        # A PBO ring has to be recreated after the readback size changes
+        if region is None:
+            self.render_region = None
+        else:
+            x, y, width, height = [int(v) for v in region]
+            x0, y0 = max(x, 0), max(y, 0)
+            x1, y1 = min(x + width, self.viewport_width), min(y + height, self.viewport_height)
+            self.render_region = (x0, y0, max(x1 - x0, 0), max(y1 - y0, 0))
+        self.read_region = self.render_region if crop_readback else None
+
+    def get_read_region(self):
+        if self.read_region is None:
+            return 0, 0, self._main_fb_dims[0], self._main_fb_dims[1]
+        return self.read_region
+
+    def _get_clip_region(self):
+        # Render region in normalized device coordinates, splats outside of it are dropped in the geometry shader
+        if self.render_region is None:
+            return -1., -1., 1., 1.
+        x, y, width, height = self.render_region
+        return (2. * x / self.viewport_width - 1, 2. * y / self.viewport_height - 1,
+                2. * (x + width) / self.viewport_width - 1, 2. * (y + height) / self.viewport_height - 1)
+
+    def _load_shader(self, defines):
+        shader = Shader()
         dirname = os.path.dirname(os.path.abspath(__file__))
-        shader.initShaderFromGLSL([os.path.join(dirname,"shaders/"+vertex_shader_models[camera_mode])],
+        shader.initShaderFromGLSL([os.path.join(dirname,"shaders/"+vertex_shader_models[self.camera_mode])],
                                   [os.path.join(dirname,"shaders/fragment.glsl")],
-                                  [os.path.join(dirname,"shaders/geometry.glsl")])
+                                  [os.path.join(dirname,"shaders/geometry.glsl")], defines=defines)
+        return shader
+
+    def init_context(self, pointcloud, camera_mode, chunk_size=2., compact_layout=False, quantized_positions=False,
+                     lod_levels=0, lod_voxel_size=None, lod_error=1.5, top_down=False, **camera_params):
+        self.context = self.GLContext()
+        self.compact_layout = compact_layout
+        # In top-down mode the camera models put the first image row at the bottom of the framebuffer
+        # (the first row in memory), so readback needs no flip and returns C-contiguous arrays
+        self.top_down = top_down
+        self.context.top_down = top_down
+        self.quantized_positions = quantized_positions
+
+        self.camera_mode = camera_mode
+        self.camera_params = camera_params
+
+        self.shader_defines = []
+        if compact_layout:
+            self.shader_defines.append('COMPACT_LAYOUT')
+        self.shader = self._load_shader(self.shader_defines)
+        self.context.object_ids = self._locate_object_uniforms(self.shader)
 
         self.camera = camera_models[camera_mode](self.context, self.shader)
         self.camera.init_intrinsics(**camera_params)
-        glverts = np.copy(pointcloud.vertices.astype(np.float32), order='C')
-        glcolors = np.copy(pointcloud.colors[:,:3].astype(np.float32)/255., order='C')
-        glids = np.arange(len(glverts), dtype=np.int32)
-
-        self.nglverts = len(glverts)
-
-        self.context.vertexbuffer = glGenBuffers(1)
-        glBindBuffer(GL_ARRAY_BUFFER, self.context.vertexbuffer)
-        glBufferData(GL_ARRAY_BUFFER, glverts.nbytes, glverts, GL_STATIC_DRAW)
-
-        self.context.colorbuffer = glGenBuffers(1)
-        glBindBuffer(GL_ARRAY_BUFFER, self.context.colorbuffer)
-        glBufferData(GL_ARRAY_BUFFER, glcolors.nbytes, glcolors, GL_STATIC_DRAW)
-
-        self.context.idbuffer = glGenBuffers(1)
-        glBindBuffer(GL_ARRAY_BUFFER, self.context.idbuffer)
-        glBufferData(GL_ARRAY_BUFFER, glids.nbytes, glids, GL_STATIC_DRAW)
+        # A projection flipped along Y mirrors the triangle winding
+        glFrontFace(GL_CW if top_down and not self.camera.y_down else GL_CCW)
+
+        self.objects = []
+        self._next_id_offset = 0
+        # The scan is the first object, so its ids are the point indices; without a point cloud it can be added
+        # later, e.g. with add_streaming_object
+        self.scan = None if pointcloud is None else \
+            self.add_object(pointcloud, chunk_size, lod_levels, lod_voxel_size, lod_error, name='scan')
+
+    @staticmethod
+    def _locate_object_uniforms(shader):
+        return {k: glGetUniformLocation(shader.program, k) for k in ['model', 'id_offset', 'clip_region']}
+
+    def add_object(self, pointcloud, chunk_size=2., lod_levels=0, lod_voxel_size=None, lod_error=1.5,
+                   transform=None, name=None):
+        # Ids of the object's points in get_image start at the returned object's id_offset
+        scene_object = PointCloudObject(pointcloud, self._next_id_offset, chunk_size, self.compact_layout,
+                                        self.quantized_positions, lod_levels, lod_voxel_size, lod_error, transform,
+                                        name)
+        self._next_id_offset += scene_object.ids_count
+        self.objects.append(scene_object)
+        return scene_object
+
+    def add_streaming_object(self, store, gpu_budget, name=None):
+        # Draws a ChunkStore from a pool of at most gpu_budget bytes of GPU buffers
+        if self.compact_layout:
+            # Compact ids are buffer positions, which the pool reuses for different chunks over time
+            raise ValueError("Streaming objects need per-point ids, they cannot be used with compact_layout")
+        scene_object = StreamingPointCloudObject(store, self._next_id_offset, gpu_budget, name)
+        self._next_id_offset += scene_object.ids_count
+        self.objects.append(scene_object)
+        return scene_object
+
+    def prefetch(self, view_matrices, max_uploads=None):
+        # Uploads chunks of streaming objects needed by upcoming poses, nearest poses first
+        for scene_object in self.objects:
+            if isinstance(scene_object, StreamingPointCloudObject):
+                scene_object.prefetch(self.camera, view_matrices, max_uploads)
+
+    def remove_object(self, scene_object):
+        self.objects.remove(scene_object)
+        scene_object.release()
 
     def locate_camera(self, quat, pose):
         self.camera.init_extrinsics(quat, pose)
 
+    def set_view_matrix(self, view_matrix):
+        self.camera.set_view_matrix(view_matrix)
+
     def get_image(self):
-        width, height = self._main_fb_dims[0], self._main_fb_dims[1]
+        x, y, width, height = self.get_read_region()
         glBindFramebuffer(GL_READ_FRAMEBUFFER, self._main_fb)
         glReadBuffer(GL_COLOR_ATTACHMENT0)
-        color_buf = glReadPixels(0, 0, width, height, GL_RGB, GL_UNSIGNED_BYTE)
-        color = np.frombuffer(color_buf, np.uint8).reshape(height, width, 3)[::-1]
+        color_buf = glReadPixels(x, y, width, height, GL_RGB, GL_UNSIGNED_BYTE)
+        color = self._flip_rows(np.frombuffer(color_buf, np.uint8).reshape(height, width, 3))
 
         glReadBuffer(GL_COLOR_ATTACHMENT1)
-        ind_buf = glReadPixels(0, 0, width, height, GL_RED_INTEGER, GL_INT)
-        indices = np.frombuffer(ind_buf, np.int32).reshape(height, width)[::-1]
-        return color, indices
+        ind_buf = glReadPixels(x, y, width, height, GL_RED_INTEGER, GL_INT)
+        indices = self._flip_rows(np.frombuffer(ind_buf, np.int32).reshape(height, width))
+        return color, self._to_point_ids(indices)
+
+    def _flip_rows(self, image):
+        return image if self.top_down else image[::-1]
+
+    def _to_point_ids(self, indices):
+        if self.compact_layout:
+            indices = indices.copy()
+            for scene_object in self.objects:
+                scene_object.to_point_ids(indices)
+        return indices
 
     def get_image_depth(self):
-        width, height = self._main_fb_dims[0], self._main_fb_dims[1]
+        x, y, width, height = self.get_read_region()
         glBindFramebuffer(GL_READ_FRAMEBUFFER, self._main_fb)
         glReadBuffer(GL_COLOR_ATTACHMENT0)
-        color_buf = glReadPixels(0, 0, width, height, GL_RGB, GL_UNSIGNED_BYTE)
-        color = np.frombuffer(color_buf, np.uint8).reshape(height, width, 3)[::-1]
-        depth_buf = glReadPixels(0, 0, width, height, GL_DEPTH_COMPONENT, GL_FLOAT)
-        depth = np.frombuffer(depth_buf, np.float32).reshape(height, width)[::-1]
+        color_buf = glReadPixels(x, y, width, height, GL_RGB, GL_UNSIGNED_BYTE)
+        color = self._flip_rows(np.frombuffer(color_buf, np.uint8).reshape(height, width, 3))
+        depth_buf = glReadPixels(x, y, width, height, GL_DEPTH_COMPONENT, GL_FLOAT)
+        depth = self._flip_rows(np.frombuffer(depth_buf, np.float32).reshape(height, width))
         return color, depth
 
     def request_color_async(self, pbo=None):
-        width, height = self._main_fb_dims[0], self._main_fb_dims[1]
+        x, y, width, height = self.get_read_region()
         if pbo is None:
             pbo = glGenBuffers(1)
             glBindBuffer(GL_PIXEL_PACK_BUFFER, pbo)
@@ -178,41 +303,239 @@ class PointCloudRenderer:
             glBindBuffer(GL_PIXEL_PACK_BUFFER, pbo)
         glBindFramebuffer(GL_READ_FRAMEBUFFER, self._main_fb)
         glReadBuffer(GL_COLOR_ATTACHMENT0)
-        glReadPixels(0, 0, width, height, GL_RGB, GL_UNSIGNED_BYTE, 0)
+        glReadPixels(x, y, width, height, GL_RGB, GL_UNSIGNED_BYTE, 0)
         return pbo
 
-    def get_requested_color(self, pbo, delete_pbo = True):
-        width, height = self._main_fb_dims[0], self._main_fb_dims[1]
+    def get_requested_color(self, pbo, delete_pbo = True, out=None):
+        _, _, width, height = self.get_read_region()
+        if out is None:
+            out = np.empty((height, width, 3), dtype=np.uint8)
         glBindBuffer(GL_PIXEL_PACK_BUFFER, pbo)
         bufferdata = glMapBuffer(GL_PIXEL_PACK_BUFFER, GL_READ_ONLY)
-        data = np.frombuffer(ctypes.string_at(bufferdata, (3 * width * height)), np.uint8).reshape(height, width, 3)
+        mapped = (ctypes.c_uint8 * (3 * width * height)).from_address(bufferdata)
+        np.copyto(out, self._flip_rows(np.frombuffer(mapped, np.uint8).reshape(height, width, 3)))
         glUnmapBuffer(GL_PIXEL_PACK_BUFFER)
         glBindBuffer(GL_PIXEL_PACK_BUFFER, 0)
         if delete_pbo:
             glDeleteBuffers(1, [pbo])
-        return data[::-1]
+        return out
+
+    def request_color_ring(self, tag=None):
+        x, y, width, height = self.get_read_region()
+
+        def read_color():
+            glBindFramebuffer(GL_READ_FRAMEBUFFER, self._main_fb)
+            glReadBuffer(GL_COLOR_ATTACHMENT0)
+            glReadPixels(x, y, width, height, GL_RGB, GL_UNSIGNED_BYTE, 0)
+
+        self.pbo_ring.push(tag, read_color)
+
+    def get_ring_color(self, out=None):
+        return self.pbo_ring.pop(out)
+
+    def init_readback_ring(self, attachments=('color', 'depth', 'ids'), depth=3):
+        # Asynchronous readback of any combination of the attachments, see request_frame and get_frame
+        if self.readback_ring is not None:
+            self.readback_ring.release()
+        _, _, width, height = self.get_read_region()
+        shapes = {}
+        for name in attachments:
+            dtype, channels = self.readback_attachments[name][3:]
+            shapes[name] = ((height, width, channels) if channels > 1 else (height, width), dtype)
+        self.readback_ring = PBOBundleRing(shapes, depth, flip_rows=not self.top_down)
+
+    def request_frame(self, tag=None):
+        # Queues reads of all attachments of the ring for the current frame, nothing waits for the GPU here
+        x, y, width, height = self.get_read_region()
+
+        def get_read_fn(read_buffer, tex_format, tex_type):
+            def read_fn():
+                glBindFramebuffer(GL_READ_FRAMEBUFFER, self._main_fb)
+                if read_buffer is not None:
+                    glReadBuffer(read_buffer)
+                glReadPixels(x, y, width, height, tex_format, tex_type, 0)
+            return read_fn
+
+        self.readback_ring.push(tag, {name: get_read_fn(*self.readback_attachments[name][:3])
+                                      for name in self.readback_ring.rings})
+
+    def get_frame(self, out=None):
+        # Oldest requested frame as (tag, {attachment: array}); without `out` the arrays may be views of mapped
+        # memory that stay valid until the ring slot is reused
+        tag, bundle = self.readback_ring.pop(out)
+        if bundle is not None and 'ids' in bundle:
+            bundle['ids'] = self._to_point_ids(bundle['ids'])
+        return tag, bundle
+
+    def init_visibility_stats(self):
+        # Counters cover the ids of the objects added so far
+        if self.visibility is not None:
+            self.visibility.release()
+        self.visibility = VisibilityAccumulator(self._next_id_offset)
+
+    def accumulate_visibility(self):
+        # Adds the last drawn frame to the statistics, runs on the GPU without readback
+        region = self.render_region
+        if region is None:
+            region = (0, 0, self.viewport_width, self.viewport_height)
+        self.visibility.accumulate(self._main_ib, region)
+
+    def get_visibility_stats(self):
+        # (frames_visible, pixels_covered) per id, the scan's entries are indexed by its point indices
+        counts = self.visibility.get_counts()
+        if self.compact_layout:
+            # Counters are indexed by buffer positions; LOD copies of a point are summed into it
+            # (a chunk is drawn at one level per frame, so frames are not counted twice)
+            point_ids = self._to_point_ids(np.arange(self.visibility.ids_count))
+            ids_count = max([x.id_offset + x.points_count for x in self.objects], default=0)
+            for ind, counter in enumerate(counts):
+                counts[ind] = np.bincount(point_ids, weights=counter, minlength=ids_count).astype(counter.dtype)
+        return tuple(counts)
+
+    def render_visibility(self, view_matrices):
+        # Renders all views, e.g. get_view_matrices of a pose track, and returns get_visibility_stats
+        self.init_visibility_stats()
+        for view_matrix in view_matrices:
+            self.set_view_matrix(view_matrix)
+            self.draw()
+            self.accumulate_visibility()
+        return self.get_visibility_stats()
+
+    def _draw_objects(self, object_ids, object_ranges, instances=1):
+        for scene_object, ranges in zip(self.objects, object_ranges):
+            if ranges is None or len(ranges[0]) == 0:
+                continue
+            first, count = ranges
+            # Row-major matrix, transposed on upload
+            glUniformMatrix4fv(object_ids['model'], 1, GL_TRUE, scene_object.model_matrix)
+            glUniform1i(object_ids['id_offset'], scene_object.id_offset)
+            glBindVertexArray(scene_object.vao)
+            if instances == 1:
+                glMultiDrawArrays(GL_POINTS, first, count, len(first))
+            else:
+                # All ranges in one call: (count, instanceCount, first, baseInstance) per range
+                commands = np.zeros((len(first), 4), dtype=np.uint32)
+                commands[:, 0] = count
+                commands[:, 1] = instances
+                commands[:, 2] = first
+                if self._indirect_buffer is None:
+                    self._indirect_buffer = glGenBuffers(1)
+                glBindBuffer(GL_DRAW_INDIRECT_BUFFER, self._indirect_buffer)
+                glBufferData(GL_DRAW_INDIRECT_BUFFER, commands.nbytes, commands, GL_STREAM_DRAW)
+                glMultiDrawArraysIndirect(GL_POINTS, None, len(commands), 0)
+                glBindBuffer(GL_DRAW_INDIRECT_BUFFER, 0)
+        glBindVertexArray(0)
 
     def draw(self):
+        if self.render_region is not None:
+            # Clearing and rasterization both stay inside the region
+            glEnable(GL_SCISSOR_TEST)
+            glScissor(*self.render_region)
         glClear(GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT)
         glClearBufferiv(GL_COLOR, 1, -1)
 
         self.shader.begin()
         self.camera.upload()
-
-        glEnableVertexAttribArray(0)
-        glBindBuffer(GL_ARRAY_BUFFER, self.context.vertexbuffer)
-        glVertexAttribPointer(0, 3, GL_FLOAT, GL_FALSE, 0, None)
-
-        glEnableVertexAttribArray(1)
-        glBindBuffer(GL_ARRAY_BUFFER, self.context.colorbuffer)
-        glVertexAttribPointer(1, 3, GL_FLOAT, GL_FALSE, 0, None)
-
-        glEnableVertexAttribArray(2)
-        glBindBuffer(GL_ARRAY_BUFFER, self.context.idbuffer)
-        glVertexAttribIPointer(2, 1, GL_INT, 0, None)
-
-        glDrawArrays(GL_POINTS, 0, self.nglverts)
-
-        glDisableVertexAttribArray(0)
-        glDisableVertexAttribArray(1)
+        glUniform4f(self.context.object_ids['clip_region'], *self._get_clip_region())
+        object_ranges = [scene_object.get_ranges(*scene_object.get_visibility(self.camera))
+                         if scene_object.visible else None for scene_object in self.objects]
+        self._draw_objects(self.context.object_ids, object_ranges)
         self.shader.end()
+        if self.render_region is not None:
+            glDisable(GL_SCISSOR_TEST)
+
+    def _delete_batch_framebuffer(self):
+        glDeleteFramebuffers(1, [self._batch_fb])
+        glDeleteTextures(3, [self._batch_cb, self._batch_ib, self._batch_db])
+        self._batch_fb = None
+
+    def init_batch_rendering(self, max_batch=16):
+        # Poses of a batch are rendered as instances, each instance goes to its own layer of the texture arrays
+        self.max_batch = max_batch
+        self.batch_context = self.GLContext()
+        self.batch_context.top_down = self.top_down
+        self.batch_shader = self._load_shader(self.shader_defines + ['LAYERED_OUTPUT', 'MAX_LAYERS {}'.format(max_batch)])
+        self.batch_camera = camera_models[self.camera_mode](self.batch_context, self.batch_shader)
+        self.batch_camera.init_intrinsics(**self.camera_params)
+        self.batch_context.mv_layers_id = glGetUniformLocation(self.batch_shader.program, 'MV_layers')
+        self.batch_context.object_ids = self._locate_object_uniforms(self.batch_shader)
+
+        if self._batch_fb is not None:
+            self._delete_batch_framebuffer()
+        width, height = self.viewport_width, self.viewport_height
+        self._batch_cb, self._batch_ib, self._batch_db = glGenTextures(3)
+        for tex, internal_format, tex_format, tex_type in [
+                (self._batch_cb, GL_RGBA8, GL_RGBA, GL_UNSIGNED_BYTE),
+                (self._batch_ib, GL_R32I, GL_RED_INTEGER, GL_INT),
+                (self._batch_db, GL_DEPTH_COMPONENT24, GL_DEPTH_COMPONENT, GL_FLOAT)]:
+            glBindTexture(GL_TEXTURE_2D_ARRAY, tex)
+            glTexImage3D(GL_TEXTURE_2D_ARRAY, 0, internal_format, width, height, max_batch, 0,
+                         tex_format, tex_type, None)
+        glBindTexture(GL_TEXTURE_2D_ARRAY, 0)
+
+        self._batch_fb = glGenFramebuffers(1)
+        glBindFramebuffer(GL_DRAW_FRAMEBUFFER, self._batch_fb)
+        glFramebufferTexture(GL_DRAW_FRAMEBUFFER, GL_COLOR_ATTACHMENT0, self._batch_cb, 0)
+        glFramebufferTexture(GL_DRAW_FRAMEBUFFER, GL_COLOR_ATTACHMENT1, self._batch_ib, 0)
+        glFramebufferTexture(GL_DRAW_FRAMEBUFFER, GL_DEPTH_ATTACHMENT, self._batch_db, 0)
+        glDrawBuffers([GL_COLOR_ATTACHMENT0, GL_COLOR_ATTACHMENT1])
+        glBindFramebuffer(GL_DRAW_FRAMEBUFFER, self._main_fb)
+
+    def _read_layers(self, texture, layers, tex_format, tex_type, dtype, channels):
+        width, height = self.viewport_width, self.viewport_height
+        data = np.empty((layers, height, width, channels), dtype=dtype)
+        if bool(glGetTextureSubImage):
+            glGetTextureSubImage(texture, 0, 0, 0, 0, width, height, layers, tex_format, tex_type, data.nbytes, data)
+        else:
+            glBindTexture(GL_TEXTURE_2D_ARRAY, texture)
+            all_layers = glGetTexImage(GL_TEXTURE_2D_ARRAY, 0, tex_format, tex_type)
+            glBindTexture(GL_TEXTURE_2D_ARRAY, 0)
+            data[:] = np.frombuffer(all_layers, dtype).reshape(-1, height, width, channels)[:layers]
+        return data if self.top_down else data[:, ::-1]
+
+    def render_batch(self, quats, positions, return_ids=False):
+        return self.render_batch_views(get_view_matrices(quats, positions), return_ids)
+
+    def render_batch_views(self, view_matrices, return_ids=False):
+        if self._batch_fb is None:
+            self.init_batch_rendering()
+        view_matrices = np.asarray(view_matrices, dtype=np.float32)
+        colors, ids = [], []
+        glBindFramebuffer(GL_DRAW_FRAMEBUFFER, self._batch_fb)
+        for batch_start in range(0, len(view_matrices), self.max_batch):
+            batch_views = view_matrices[batch_start:batch_start + self.max_batch]
+            layers = len(batch_views)
+            visibility = [None] * len(self.objects)
+            for ind in range(layers):
+                self.batch_camera.set_view_matrix(batch_views[ind])
+                for obj_ind, scene_object in enumerate(self.objects):
+                    if not scene_object.visible:
+                        continue
+                    visible, levels = scene_object.get_visibility(self.batch_camera)
+                    if visibility[obj_ind] is not None and visible is not None:
+                        # The whole batch shares one level per chunk, the finest one required by any pose
+                        visible |= visibility[obj_ind][0]
+                        if levels is not None:
+                            levels = np.minimum(levels, visibility[obj_ind][1])
+                    visibility[obj_ind] = (visible, levels)
+            object_ranges = [None if x is None else scene_object.get_ranges(*x)
+                             for scene_object, x in zip(self.objects, visibility)]
+
+            glClear(GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT)
+            glClearBufferiv(GL_COLOR, 1, -1)
+            self.batch_shader.begin()
+            self.batch_camera.upload()
+            # Row-major matrices, transposed on upload
+            glUniformMatrix4fv(self.batch_context.mv_layers_id, layers, GL_TRUE, np.ascontiguousarray(batch_views))
+            self._draw_objects(self.batch_context.object_ids, object_ranges, instances=layers)
+            self.batch_shader.end()
+
+            colors.append(self._read_layers(self._batch_cb, layers, GL_RGB, GL_UNSIGNED_BYTE, np.uint8, 3))
+            if return_ids:
+                layer_ids = self._read_layers(self._batch_ib, layers, GL_RED_INTEGER, GL_INT, np.int32, 1)[..., 0]
+                ids.append(self._to_point_ids(layer_ids))
+        glBindFramebuffer(GL_DRAW_FRAMEBUFFER, self._main_fb)
+        colors = np.concatenate(colors, axis=0)
+        if return_ids:
+            return colors, np.concatenate(ids, axis=0)
+        return colors
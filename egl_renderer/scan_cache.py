@@ -0,0 +1,75 @@
+import os
+import shutil
+import hashlib
+import tempfile
+import numpy as np
+
+
+class PointCloudArrays:
+    def __init__(self, vertices, colors):
+        self.vertices = vertices
+        self.colors = colors
+
+
+class ScanCache:
+    def __init__(self, cache_dir, max_size_gb=20.):
+        self.cache_dir = os.path.abspath(os.path.expanduser(cache_dir))
+        self.max_size = int(max_size_gb * 1024 ** 3)
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    @staticmethod
+    def get_key(zippath, entry_name):
+        zippath = os.path.abspath(zippath)
+        stat = os.stat(zippath)
+        key_str = "{}|{}|{}|{}".format(zippath, stat.st_size, stat.st_mtime_ns, entry_name)
+        return hashlib.sha1(key_str.encode('utf-8')).hexdigest()
+
+    def get(self, zippath, entry_name):
+        entry_dir = os.path.join(self.cache_dir, self.get_key(zippath, entry_name))
+        if not os.path.isdir(entry_dir):
+            return None
+        try:
+            vertices = np.load(os.path.join(entry_dir, 'vertices.npy'), mmap_mode='r')
+            colors = np.load(os.path.join(entry_dir, 'colors.npy'), mmap_mode='r')
+        except (OSError, ValueError):
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            return None
+        # Directory mtime serves as the last access time for LRU eviction
+        os.utime(entry_dir)
+        return PointCloudArrays(vertices, colors)
+
+    def put(self, zippath, entry_name, vertices, colors):
+        entry_dir = os.path.join(self.cache_dir, self.get_key(zippath, entry_name))
+        vertices = np.asarray(vertices, dtype=np.float32)
+        colors = np.asarray(colors, dtype=np.uint8)
+        self.evict(vertices.nbytes + colors.nbytes)
+        # Write into a temporary directory first, so concurrent readers never see a partial entry
+        tmp_dir = tempfile.mkdtemp(dir=self.cache_dir, prefix='.tmp_')
+        try:
+            np.save(os.path.join(tmp_dir, 'vertices.npy'), vertices)
+            np.save(os.path.join(tmp_dir, 'colors.npy'), colors)
+            os.rename(tmp_dir, entry_dir)
+        except OSError:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            if not os.path.isdir(entry_dir):
+                raise
+        return self.get(zippath, entry_name)
+
+    def get_entries(self):
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            if name.startswith('.') or not os.path.isdir(path):
+                continue
+            size = sum(os.path.getsize(os.path.join(path, fn)) for fn in os.listdir(path))
+            entries.append((os.path.getmtime(path), size, path))
+        return sorted(entries)
+
+    def evict(self, required_size=0):
+        entries = self.get_entries()
+        total_size = sum(size for _, size, _ in entries) + required_size
+        for _, size, path in entries:
+            if total_size <= self.max_size:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            total_size -= size
@@ -0,0 +1,128 @@
+import numpy as np
+from OpenGL.GL import *
+from .chunks import PointChunks
+
+
+def quantize_positions(verts):
+    # 16-bit normalized offsets inside the bounding box, restored in the shader as origin + offset*scale
+    verts = np.asarray(verts, dtype=np.float32)
+    origin = verts.min(axis=0)
+    scale = np.maximum(verts.max(axis=0) - origin, 1e-6).astype(np.float32)
+    quantized = np.empty(verts.shape, dtype=np.uint16)
+    np.rint((verts - origin) * (65535. / scale).astype(np.float32), out=quantized, casting='unsafe')
+    return quantized, origin, scale
+
+
+class PointCloudObject:
+    # A point cloud with its own buffers and VAO; ids it writes to the id buffer start at id_offset
+    def __init__(self, pointcloud, id_offset, chunk_size=2., compact_layout=False, quantized_positions=False,
+                 lod_levels=0, lod_voxel_size=None, lod_error=1.5, transform=None, name=None):
+        self.name = name
+        self.id_offset = id_offset
+        self.compact_layout = compact_layout
+        self.lod_error = lod_error
+        self.visible = True
+        if chunk_size is None:
+            self.chunks = None
+            order = slice(None)
+        else:
+            # Points are grouped by chunk in the buffers, ids still refer to the original point order
+            self.chunks = PointChunks(pointcloud.vertices, chunk_size, lod_levels, lod_voxel_size)
+            order = self.chunks.vertex_order
+
+        # Maps buffer positions to object coordinates, dequantization is folded into the model matrix
+        self.vertex_transform = np.eye(4)
+        if quantized_positions:
+            glverts, origin, scale = quantize_positions(pointcloud.vertices[order])
+            self.vertex_transform[:3, :3] = np.diag(scale)
+            self.vertex_transform[:3, 3] = origin
+        else:
+            glverts = np.ascontiguousarray(pointcloud.vertices[order], dtype=np.float32)
+        if compact_layout:
+            glcolors = np.ascontiguousarray(pointcloud.colors[order, :3], dtype=np.uint8)
+        else:
+            glcolors = np.ascontiguousarray(pointcloud.colors[order, :3], dtype=np.float32)/255.
+        self.nglverts = len(glverts)
+        self.points_count = len(pointcloud.vertices)
+
+        # Attribute layout is recorded once in the VAO, drawing only binds it
+        self.vao = glGenVertexArrays(1)
+        glBindVertexArray(self.vao)
+        self.vertexbuffer = glGenBuffers(1)
+        glBindBuffer(GL_ARRAY_BUFFER, self.vertexbuffer)
+        glBufferData(GL_ARRAY_BUFFER, glverts.nbytes, glverts, GL_STATIC_DRAW)
+        glEnableVertexAttribArray(0)
+        if quantized_positions:
+            glVertexAttribPointer(0, 3, GL_UNSIGNED_SHORT, GL_TRUE, 0, None)
+        else:
+            glVertexAttribPointer(0, 3, GL_FLOAT, GL_FALSE, 0, None)
+
+        self.colorbuffer = glGenBuffers(1)
+        glBindBuffer(GL_ARRAY_BUFFER, self.colorbuffer)
+        glBufferData(GL_ARRAY_BUFFER, glcolors.nbytes, glcolors, GL_STATIC_DRAW)
+        glEnableVertexAttribArray(1)
+        if compact_layout:
+            glVertexAttribPointer(1, 3, GL_UNSIGNED_BYTE, GL_TRUE, 0, None)
+        else:
+            glVertexAttribPointer(1, 3, GL_FLOAT, GL_FALSE, 0, None)
+
+        if compact_layout:
+            # Instance ids come from gl_VertexID, i.e. the position in the buffers
+            self.idbuffer = None
+        else:
+            glids = np.arange(self.nglverts, dtype=np.int32) if self.chunks is None else \
+                self.chunks.vertex_order.astype(np.int32)
+            self.idbuffer = glGenBuffers(1)
+            glBindBuffer(GL_ARRAY_BUFFER, self.idbuffer)
+            glBufferData(GL_ARRAY_BUFFER, glids.nbytes, glids, GL_STATIC_DRAW)
+            glEnableVertexAttribArray(2)
+            glVertexAttribIPointer(2, 1, GL_INT, 0, None)
+        glBindVertexArray(0)
+        glBindBuffer(GL_ARRAY_BUFFER, 0)
+
+        self.set_transform(np.eye(4) if transform is None else transform)
+
+    @property
+    def ids_count(self):
+        # Size of the id range the object writes before remapping to point indices
+        return self.nglverts if self.compact_layout else self.points_count
+
+    def set_transform(self, transform):
+        # Object to world transform: rotation, translation and an optional uniform scale
+        self.transform = np.asarray(transform, dtype=np.float64)
+        self.model_matrix = np.matmul(self.transform, self.vertex_transform).astype(np.float32)
+        if self.chunks is not None:
+            self.world_centers = np.matmul(self.chunks.centers, self.transform[:3, :3].T) + self.transform[:3, 3]
+            self.world_radii = self.chunks.radii * np.linalg.norm(self.transform[:3, :3], axis=0).max()
+            self.inverse_transform = np.linalg.inv(self.transform)
+
+    def get_visibility(self, camera):
+        if self.chunks is None:
+            return None, None
+        visible = camera.get_visible_spheres(self.world_centers, self.world_radii)
+        levels = None
+        if len(self.chunks.level_first) > 1:
+            # Voxel sizes and distances scale together, so levels can be chosen in object coordinates
+            local_position = np.matmul(self.inverse_transform[:3, :3], camera.context.camera_position) + \
+                             self.inverse_transform[:3, 3]
+            levels = self.chunks.select_levels(local_position, camera.context.pixel_angle, self.lod_error)
+        return visible, levels
+
+    def get_ranges(self, visible=None, levels=None):
+        if self.chunks is None:
+            return np.zeros(1, dtype=np.int32), np.array([self.nglverts], dtype=np.int32)
+        return self.chunks.visible_ranges(visible, levels)
+
+    def to_point_ids(self, indices):
+        # Buffer positions written through gl_VertexID are mapped back to point indices in place
+        if not self.compact_layout or self.chunks is None:
+            return indices
+        local = indices - self.id_offset
+        inside = (local >= 0) & (local < self.nglverts)
+        indices[inside] = self.id_offset + self.chunks.vertex_order[local[inside]]
+        return indices
+
+    def release(self):
+        buffers = [x for x in [self.vertexbuffer, self.colorbuffer, self.idbuffer] if x is not None]
+        glDeleteBuffers(len(buffers), buffers)
+        glDeleteVertexArrays(1, [self.vao])
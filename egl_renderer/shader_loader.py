@@ -7,8 +7,17 @@ def printOpenGLError():
     if (err != gl.GL_NO_ERROR):
         print('GLERROR: ', gl.gluErrorString(err))  # pylint: disable=E1101
 
+def insert_defines(source, defines):
+    # Defines have to go right after the #version line
+    if not defines:
+        return source
+    version_end = source.index(b'\n') + 1
+    define_lines = b''.join(b'#define ' + define.encode('ASCII') + b'\n' for define in defines)
+    return source[:version_end] + define_lines + source[version_end:]
+
 class Shader(object):
-    def initShaderFromGLSL(self, vertex_shader_paths, fragment_shader_paths, geometry_shader_paths = None):
+    def initShaderFromGLSL(self, vertex_shader_paths, fragment_shader_paths, geometry_shader_paths = None,
+                           defines = None):
         vertex_shader_source_list = []
         fragment_shader_source_list = []
         geometry_shader_source_list = []
@@ -17,21 +26,43 @@ class Shader(object):
             for GLSL in vertex_shader_paths:
                 absDIR = os.path.abspath(os.path.join(os.path.join(os.path.dirname(__file__), "."), GLSL))
                 f = open(absDIR, 'rb')
-                vertex_shader_source_list.append(f.read())
+                vertex_shader_source_list.append(insert_defines(f.read(), defines))
                 f.close()
             for GLSL in fragment_shader_paths:
                 absDIR = os.path.abspath(os.path.join(os.path.join(os.path.dirname(__file__), "."), GLSL))
                 f = open(absDIR, 'rb')
-                fragment_shader_source_list.append(f.read())
+                fragment_shader_source_list.append(insert_defines(f.read(), defines))
                 f.close()
             if geometry_shader_paths is not None:
                 for GLSL in geometry_shader_paths:
                     absDIR = os.path.abspath(os.path.join(os.path.join(os.path.dirname(__file__), "."), GLSL))
                     f = open(absDIR, 'rb')
-                    geometry_shader_source_list.append(f.read())
+                    geometry_shader_source_list.append(insert_defines(f.read(), defines))
                     f.close()
             self.initShader(vertex_shader_source_list, fragment_shader_source_list, geometry_shader_source_list)
 
+    def initComputeShaderFromGLSL(self, compute_shader_paths, defines = None):
+        compute_shader_source_list = []
+        for GLSL in compute_shader_paths:
+            absDIR = os.path.abspath(os.path.join(os.path.join(os.path.dirname(__file__), "."), GLSL))
+            f = open(absDIR, 'rb')
+            compute_shader_source_list.append(insert_defines(f.read(), defines))
+            f.close()
+        self.program = gl.glCreateProgram()  # pylint: disable=E1111
+        printOpenGLError()
+        self.cs = gl.glCreateShader(gl.GL_COMPUTE_SHADER)  # pylint: disable=E1111
+        gl.glShaderSource(self.cs, compute_shader_source_list)
+        gl.glCompileShader(self.cs)
+        if (gl.GL_TRUE != gl.glGetShaderiv(self.cs, gl.GL_COMPILE_STATUS)):
+            err = gl.glGetShaderInfoLog(self.cs)
+            raise Exception(err)
+        gl.glAttachShader(self.program, self.cs)
+        gl.glLinkProgram(self.program)
+        if (gl.GL_TRUE != gl.glGetProgramiv(self.program, gl.GL_LINK_STATUS)):
+            err = gl.glGetProgramInfoLog(self.program)
+            raise Exception(err)
+        printOpenGLError()
+
     def initShader(self, vertex_shader_source_list, fragment_shader_source_list, geometry_shader_source_list):
         # create program
         self.program = gl.glCreateProgram()  # pylint: disable=E1111
@@ -0,0 +1,29 @@
+#version 430 core
+
+layout(local_size_x = 16, local_size_y = 16) in;
+
+// Id attachment of the rendered frame, -1 where no point was drawn
+layout(r32i, binding = 0) uniform readonly iimage2D ids_image;
+
+// Per id: frames the id was visible in, pixels it covered over all frames and the last frame it was counted in
+layout(std430, binding = 0) buffer FramesVisible { uint frames_visible[]; };
+layout(std430, binding = 1) buffer PixelsCovered { uint pixels_covered[]; };
+layout(std430, binding = 2) buffer LastFrame { int last_frame[]; };
+
+// Pixels taken into account (x, y, width, height) and the index of the current frame
+uniform ivec4 region;
+uniform int frame_index;
+uniform int ids_count;
+
+void main(){
+	ivec2 offset = ivec2(gl_GlobalInvocationID.xy);
+	if (any(greaterThanEqual(offset, region.zw)))
+		return;
+	int id = imageLoad(ids_image, region.xy + offset).r;
+	if (id < 0 || id >= ids_count)
+		return;
+	atomicAdd(pixels_covered[id], 1u);
+	// Only the first pixel of the id in this frame sees a different last frame
+	if (atomicExchange(last_frame[id], frame_index) != frame_index)
+		atomicAdd(frames_visible[id], 1u);
+}
@@ -0,0 +1,14 @@
+#version 330 core
+
+in vec2 uv;
+
+uniform sampler2D video;
+
+layout(location = 0) out vec3 color;
+layout(location = 1) out int pix_inst_id;
+
+void main(){
+	color = texture(video, uv).rgb;
+	// Video pixels do not belong to any point
+	pix_inst_id = -1;
+}
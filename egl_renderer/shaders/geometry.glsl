@@ -8,13 +8,30 @@ in VS_OUT {
     vec3 color;
     int inst_id;
     float depth;
+#ifdef LAYERED_OUTPUT
+    int layer;
+#endif
 } gs_in[];
 
+// Render region in normalized device coordinates (x0, y0, x1, y1)
+uniform vec4 clip_region = vec4(-1., -1., 1., 1.);
+
 void main() {
     vec4 position = gl_in[0].gl_Position;
     float size_mul = 1./(1+0.2*gs_in[0].depth)*position.w;
+    if (position.w > 0) {
+        // Splats entirely outside of the region are dropped before rasterization
+        vec2 splat_center = position.xy/position.w;
+        float splat_radius = 0.01*size_mul/position.w;
+        if (any(lessThan(splat_center + splat_radius, clip_region.xy)) ||
+            any(greaterThan(splat_center - splat_radius, clip_region.zw)))
+            return;
+    }
     vcolor = gs_in[0].color;
     frag_inst_id = gs_in[0].inst_id;
+#ifdef LAYERED_OUTPUT
+    gl_Layer = gs_in[0].layer;
+#endif
     gl_Position = position + vec4(-0.01, -0.01, 0.0, 0.0)*size_mul;
     EmitVertex();
 
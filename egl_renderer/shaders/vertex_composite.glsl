@@ -0,0 +1,13 @@
+#version 330 core
+
+// Full-viewport quad from gl_VertexID, drawn as a 4 vertex triangle strip
+// Texture rectangle (s0, t0, s1, t1) of the video shown in the viewport
+uniform vec4 src_rect;
+
+out vec2 uv;
+
+void main(){
+	vec2 corner = vec2(gl_VertexID & 1, gl_VertexID >> 1);
+	uv = mix(src_rect.xy, src_rect.zw, corner);
+	gl_Position = vec4(corner * 2. - 1., 0., 1.);
+}
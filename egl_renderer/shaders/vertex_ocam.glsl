@@ -4,26 +4,44 @@
 // Input vertex data, different for all executions of this shader.
 layout(location = 0) in vec3 vertexPos;
 layout(location = 1) in vec3 vertexColor;
+#ifndef COMPACT_LAYOUT
 layout(location = 2) in int vertexId;
+#endif
+
+// Object to world transform, also restores quantized positions; ids of the object start at id_offset
+uniform mat4 model;
+uniform int id_offset;
 
 // Output data ; will be interpolated for each fragment.
 out VS_OUT {
     vec3 color;
 	int inst_id;
 	float depth;
+#ifdef LAYERED_OUTPUT
+	int layer;
+#endif
 } vs_out;
 
 // Values that stay constant for the whole mesh.
-uniform mat4 MV;
-uniform double ocam_invpol[INVPOL_DEGREE];
-uniform dvec3 ocam_affine;
-uniform dvec2 ocam_center_off;
-uniform float ocam_theta_thresh;
-uniform float far;
+// Camera state, filled from a uniform buffer by the camera model
+layout(std140, row_major) uniform Camera {
+	mat4 camera_view;
+	double ocam_invpol[INVPOL_DEGREE];
+	dvec3 ocam_affine;
+	dvec2 ocam_center_off;
+	float far;
+};
+#ifdef LAYERED_OUTPUT
+// One view matrix per output layer, selected by the instance
+uniform mat4 MV_layers[MAX_LAYERS];
+#define MV MV_layers[gl_InstanceID]
+#else
+#define MV camera_view
+#endif
 //uniform vec3 OFFSET;
 void main(){
 
-	vec4 vertexPosMV = MV * vec4(vertexPos, 1);
+	vec4 vertexPosMV = MV * (model * vec4(vertexPos, 1));
 	float xynorm = length(vertexPosMV.xy);
 	double theta = -atan(vertexPosMV.z, xynorm);
 	double cur_theta = theta;
@@ -42,6 +60,13 @@ void main(){
 					   1.0);
 
 	vs_out.color = vertexColor;
-	vs_out.inst_id = vertexId;
+#ifdef COMPACT_LAYOUT
+	vs_out.inst_id = id_offset + gl_VertexID;
+#else
+	vs_out.inst_id = id_offset + vertexId;
+#endif
 	vs_out.depth = abs(vertexPosMV.z);
+#ifdef LAYERED_OUTPUT
+	vs_out.layer = gl_InstanceID;
+#endif
 }
\ No newline at end of file
@@ -0,0 +1,71 @@
+#version 400
+// Must match OcamFastModel.lut_size
+#define OCAM_LUT_SIZE 256
+
+// Input vertex data, different for all executions of this shader.
+layout(location = 0) in vec3 vertexPos;
+layout(location = 1) in vec3 vertexColor;
+#ifndef COMPACT_LAYOUT
+layout(location = 2) in int vertexId;
+#endif
+
+// Object to world transform, also restores quantized positions; ids of the object start at id_offset
+uniform mat4 model;
+uniform int id_offset;
+
+// Output data ; will be interpolated for each fragment.
+out VS_OUT {
+    vec3 color;
+	int inst_id;
+	float depth;
+#ifdef LAYERED_OUTPUT
+	int layer;
+#endif
+} vs_out;
+
+// Values that stay constant for the whole mesh.
+// Camera state, filled from a uniform buffer by the camera model
+layout(std140, row_major) uniform Camera {
+	mat4 camera_view;
+	// rho sampled uniformly over theta; ocam_lut_range is (first theta, samples per radian)
+	float ocam_lut[OCAM_LUT_SIZE];
+	vec2 ocam_lut_range;
+	vec3 ocam_affine;
+	vec2 ocam_center_off;
+	float far;
+};
+#ifdef LAYERED_OUTPUT
+// One view matrix per output layer, selected by the instance
+uniform mat4 MV_layers[MAX_LAYERS];
+#define MV MV_layers[gl_InstanceID]
+#else
+#define MV camera_view
+#endif
+//uniform vec3 OFFSET;
+void main(){
+
+	vec4 vertexPosMV = MV * (model * vec4(vertexPos, 1));
+	float xynorm = length(vertexPosMV.xy);
+	float theta = -atan(vertexPosMV.z, xynorm);
+	float lut_pos = (theta - ocam_lut_range.x)*ocam_lut_range.y;
+	int lut_ind = clamp(int(lut_pos), 0, OCAM_LUT_SIZE - 2);
+	float rho = mix(ocam_lut[lut_ind], ocam_lut[lut_ind + 1], lut_pos - float(lut_ind));
+
+	vec2 uv = vertexPosMV.xy*rho/xynorm;
+	vec2 res = vec2(uv.x + uv.y*ocam_affine.z, dot(uv, ocam_affine.yx)) + ocam_center_off.yx;
+
+	gl_Position = vec4(res,
+	                   length(vertexPosMV)/far*2-1,
+					   1.0);
+
+	vs_out.color = vertexColor;
+#ifdef COMPACT_LAYOUT
+	vs_out.inst_id = id_offset + gl_VertexID;
+#else
+	vs_out.inst_id = id_offset + vertexId;
+#endif
+	vs_out.depth = abs(vertexPosMV.z);
+#ifdef LAYERED_OUTPUT
+	vs_out.layer = gl_InstanceID;
+#endif
+}
\ No newline at end of file
@@ -4,23 +4,42 @@
 // Input vertex data, different for all executions of this shader.
 layout(location = 0) in vec3 vertexPos;
 layout(location = 1) in vec3 vertexColor;
+#ifndef COMPACT_LAYOUT
 layout(location = 2) in int vertexId;
+#endif
+
+// Object to world transform, also restores quantized positions; ids of the object start at id_offset
+uniform mat4 model;
+uniform int id_offset;
 
 // Output data ; will be interpolated for each fragment.
 out VS_OUT {
     vec3 color;
 	int inst_id;
 	float depth;
+#ifdef LAYERED_OUTPUT
+	int layer;
+#endif
 } vs_out;
 
 // Values that stay constant for the whole mesh.
-uniform mat4 MV;
-uniform float distorsion_coeff[DIST_DEGREE];
-uniform vec2 center_off;
-uniform vec2 focal_dist;
-uniform float far;
+// Camera state, filled from a uniform buffer by the camera model
+layout(std140, row_major) uniform Camera {
+	mat4 camera_view;
+	float distorsion_coeff[DIST_DEGREE];
+	vec2 center_off;
+	vec2 focal_dist;
+	float far;
+};
+#ifdef LAYERED_OUTPUT
+// One view matrix per output layer, selected by the instance
+uniform mat4 MV_layers[MAX_LAYERS];
+#define MV MV_layers[gl_InstanceID]
+#else
+#define MV camera_view
+#endif
 void main(){
-	vec4 vertexPosMV = MV * vec4(vertexPos, 1);
+	vec4 vertexPosMV = MV * (model * vec4(vertexPos, 1));
 	vec2 xy1 = vertexPosMV.xy/vertexPosMV.z;
 	float radius_sq = dot(xy1,xy1);
 	float radius_quad = radius_sq*radius_sq;
@@ -36,6 +55,13 @@ void main(){
 					   1.0);
 
 	vs_out.color = vertexColor;
-	vs_out.inst_id = vertexId;
+#ifdef COMPACT_LAYOUT
+	vs_out.inst_id = id_offset + gl_VertexID;
+#else
+	vs_out.inst_id = id_offset + vertexId;
+#endif
 	vs_out.depth = abs(vertexPosMV.z);
+#ifdef LAYERED_OUTPUT
+	vs_out.layer = gl_InstanceID;
+#endif
 }
\ No newline at end of file
@@ -0,0 +1,221 @@
+import os
+import json
+import shutil
+import logging
+import tempfile
+import numpy as np
+from collections import OrderedDict
+from OpenGL.GL import *
+from .chunks import PointChunks
+
+
+class ChunkStore:
+    # A point cloud on disk split into spatial chunks: points are stored chunk after chunk in Morton order
+    # and memory-mapped, so only the chunks that are uploaded to the GPU are ever read
+    def __init__(self, path):
+        self.path = path
+        self.vertices = np.load(os.path.join(path, 'vertices.npy'), mmap_mode='r')
+        self.colors = np.load(os.path.join(path, 'colors.npy'), mmap_mode='r')
+        self.point_ids = np.load(os.path.join(path, 'point_ids.npy'), mmap_mode='r')
+        with np.load(os.path.join(path, 'chunks.npz')) as chunks:
+            self.first = chunks['first']
+            self.count = chunks['count']
+            self.centers = chunks['centers']
+            self.radii = chunks['radii']
+        self.points_count = len(self.vertices)
+        self.max_chunk_points = int(self.count.max()) if len(self.count) > 0 else 1
+        # Inside a ScanCache the directory mtime is the last access time used for eviction
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+    def __len__(self):
+        return len(self.first)
+
+    @classmethod
+    def build(cls, pointcloud, path, chunk_size=2., max_chunk_points=65536):
+        # Chunks of PointChunks with more than max_chunk_points points are split into consecutive pieces,
+        # so that every chunk fits into one slot of the GPU pool
+        chunks = PointChunks(pointcloud.vertices, chunk_size)
+        piece_first = [np.arange(first, first + count, max_chunk_points)
+                       for first, count in zip(chunks.first, chunks.count)]
+        first = np.concatenate(piece_first).astype(np.int64)
+        count = np.diff(np.concatenate([first, [len(chunks.order)]])).astype(np.int64)
+        sorted_verts = np.asarray(pointcloud.vertices, dtype=np.float32)[chunks.order]
+        bbox_min = np.minimum.reduceat(sorted_verts, first, axis=0).astype(np.float64)
+        bbox_max = np.maximum.reduceat(sorted_verts, first, axis=0).astype(np.float64)
+        # Written to a temporary directory first, so readers never see a partial store
+        tmp_dir = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(path)), prefix='.tmp_')
+        try:
+            np.save(os.path.join(tmp_dir, 'vertices.npy'), sorted_verts)
+            np.save(os.path.join(tmp_dir, 'colors.npy'),
+                    np.asarray(pointcloud.colors, dtype=np.uint8)[chunks.order, :3])
+            np.save(os.path.join(tmp_dir, 'point_ids.npy'), chunks.order.astype(np.int32))
+            np.savez(os.path.join(tmp_dir, 'chunks.npz'), first=first, count=count,
+                     centers=(bbox_min + bbox_max) / 2., radii=np.linalg.norm(bbox_max - bbox_min, axis=1) / 2.)
+            with open(os.path.join(tmp_dir, 'store.json'), 'w') as info_file:
+                json.dump({'chunk_size': chunk_size, 'max_chunk_points': max_chunk_points}, info_file)
+            os.rename(tmp_dir, path)
+        except OSError:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            # Another process may have built the same store meanwhile
+            if not os.path.isfile(os.path.join(path, 'store.json')):
+                raise
+        return cls(path)
+
+    @classmethod
+    def open_or_build(cls, pointcloud_fn, path, chunk_size=2., max_chunk_points=65536):
+        # pointcloud_fn is called only when the store has to be built
+        if os.path.isfile(os.path.join(path, 'store.json')):
+            return cls(path)
+        return cls.build(pointcloud_fn(), path, chunk_size, max_chunk_points)
+
+
+class StreamingPointCloudObject:
+    # Scene object drawing a ChunkStore through a fixed pool of GPU slots, one chunk per slot.
+    # Chunks visible from the camera are uploaded on demand, the least recently used ones are evicted first;
+    # draw() renders only the resident chunks. Ids written to the id buffer are the original point indices
+    bytes_per_point = 12 + 3 + 4
+
+    def __init__(self, store, id_offset, gpu_budget, name=None):
+        self.store = store
+        self.name = name
+        self.id_offset = id_offset
+        self.visible = True
+        self.model_matrix = np.eye(4, dtype=np.float32)
+        self.slot_points = store.max_chunk_points
+        self.slots_count = min(max(int(gpu_budget // (self.slot_points * self.bytes_per_point)), 1), len(store))
+        pool_points = self.slots_count * self.slot_points
+
+        self.vao = glGenVertexArrays(1)
+        glBindVertexArray(self.vao)
+        self.vertexbuffer, self.colorbuffer = [int(x) for x in glGenBuffers(2)]
+        glBindBuffer(GL_ARRAY_BUFFER, self.vertexbuffer)
+        glBufferData(GL_ARRAY_BUFFER, pool_points * 12, None, GL_DYNAMIC_DRAW)
+        glEnableVertexAttribArray(0)
+        glVertexAttribPointer(0, 3, GL_FLOAT, GL_FALSE, 0, None)
+        glBindBuffer(GL_ARRAY_BUFFER, self.colorbuffer)
+        glBufferData(GL_ARRAY_BUFFER, pool_points * 3, None, GL_DYNAMIC_DRAW)
+        glEnableVertexAttribArray(1)
+        glVertexAttribPointer(1, 3, GL_UNSIGNED_BYTE, GL_TRUE, 0, None)
+        # Point ids are uploaded with the chunks: slots are reused, so pool positions do not identify points
+        self.idbuffer = glGenBuffers(1)
+        glBindBuffer(GL_ARRAY_BUFFER, self.idbuffer)
+        glBufferData(GL_ARRAY_BUFFER, pool_points * 4, None, GL_DYNAMIC_DRAW)
+        glEnableVertexAttribArray(2)
+        glVertexAttribIPointer(2, 1, GL_INT, 0, None)
+        glBindVertexArray(0)
+        glBindBuffer(GL_ARRAY_BUFFER, 0)
+
+        # Chunk -> slot in LRU order (least recently used first), -1 in chunk_slots for chunks on disk only
+        self.resident = OrderedDict()
+        self.chunk_slots = np.full(len(store), -1, dtype=np.int64)
+        self.free_slots = list(range(self.slots_count - 1, -1, -1))
+        # Chunks drawn by the last frame, prefetching does not evict them
+        self.last_used = np.zeros(0, dtype=np.int64)
+        self.uploads = 0
+        self.evictions = 0
+        # Visible chunks left out because they did not fit into the pool, and frames that left some out
+        self.dropped_chunks = 0
+        self.dropped_frames = 0
+
+    @property
+    def points_count(self):
+        return self.store.points_count
+
+    @property
+    def ids_count(self):
+        return self.store.points_count
+
+    def _upload(self, chunk, slot):
+        first, count = int(self.store.first[chunk]), int(self.store.count[chunk])
+        pool_first = slot * self.slot_points
+        for buffer, data, item_size in [(self.vertexbuffer, self.store.vertices, 12),
+                                        (self.colorbuffer, self.store.colors, 3),
+                                        (self.idbuffer, self.store.point_ids, 4)]:
+            glBindBuffer(GL_ARRAY_BUFFER, buffer)
+            glBufferSubData(GL_ARRAY_BUFFER, pool_first * item_size, count * item_size,
+                            np.ascontiguousarray(data[first:first + count]))
+        glBindBuffer(GL_ARRAY_BUFFER, 0)
+        self.uploads += 1
+
+    def _acquire_slot(self, protected):
+        if len(self.free_slots) > 0:
+            return self.free_slots.pop()
+        for chunk in self.resident:
+            if chunk not in protected:
+                slot = self.resident.pop(chunk)
+                self.chunk_slots[chunk] = -1
+                self.evictions += 1
+                return slot
+        return None
+
+    def make_resident(self, chunks, protected=None, max_uploads=None):
+        # Marks the chunks as recently used and uploads the missing ones, never evicting protected chunks;
+        # returns False if not all of them fit
+        protected = set(chunks) if protected is None else protected | set(chunks)
+        uploads = 0
+        for chunk in chunks:
+            if chunk in self.resident:
+                self.resident.move_to_end(chunk)
+                continue
+            if max_uploads is not None and uploads >= max_uploads:
+                return False
+            slot = self._acquire_slot(protected)
+            if slot is None:
+                return False
+            self._upload(chunk, slot)
+            uploads += 1
+            self.resident[chunk] = slot
+            self.chunk_slots[chunk] = slot
+        return True
+
+    def _get_needed_chunks(self, camera, view_matrix=None):
+        # Visible chunks, nearest first; beyond the pool size only the nearest ones are kept
+        visible = camera.get_visible_spheres(self.store.centers, self.store.radii, view_matrix)
+        chunks = np.flatnonzero(visible)
+        if view_matrix is None:
+            camera_position = camera.context.camera_position
+        else:
+            camera_position = -np.matmul(view_matrix[:3, :3].T, view_matrix[:3, 3])
+        dists = np.linalg.norm(self.store.centers[chunks] - camera_position, axis=1) - self.store.radii[chunks]
+        return visible, chunks[np.argsort(dists, kind='stable')][:self.slots_count]
+
+    def get_visibility(self, camera):
+        visible, needed = self._get_needed_chunks(camera)
+        dropped = int(visible.sum()) - len(needed)
+        if dropped > 0:
+            if self.dropped_frames == 0:
+                logging.warning("GPU budget holds {} chunks, {} farthest visible chunks of '{}' are not drawn "
+                                "(warned once, see dropped_chunks)".format(self.slots_count, dropped, self.name))
+            self.dropped_chunks += dropped
+            self.dropped_frames += 1
+        self.make_resident([int(x) for x in needed])
+        return visible, None
+
+    def prefetch(self, camera, view_matrices, max_uploads=None):
+        # Uploads chunks visible from upcoming poses into free slots or slots of chunks the last frame did not use
+        protected = set(int(x) for x in self.last_used)
+        for view_matrix in view_matrices:
+            _, needed = self._get_needed_chunks(camera, np.asarray(view_matrix, dtype=np.float64))
+            needed = [int(x) for x in needed]
+            if not self.make_resident(needed, protected, max_uploads):
+                break
+            protected |= set(needed)
+
+    def get_ranges(self, visible=None, levels=None):
+        chunks = np.arange(len(self.store)) if visible is None else np.flatnonzero(visible)
+        slots = self.chunk_slots[chunks]
+        resident = slots >= 0
+        self.last_used = chunks[resident]
+        slots = slots[resident]
+        return (slots * self.slot_points).astype(np.int32), self.store.count[chunks[resident]].astype(np.int32)
+
+    def to_point_ids(self, indices):
+        # The id buffer already holds point indices
+        return indices
+
+    def release(self):
+        glDeleteBuffers(3, [self.vertexbuffer, self.colorbuffer, self.idbuffer])
+        glDeleteVertexArrays(1, [self.vao])
@@ -0,0 +1,70 @@
+import numpy as np
+from OpenGL.GL import *
+
+
+class UniformBuffer:
+    # Host copy of a std140 uniform block; set() marks the changed byte range and upload() sends only that range
+    def __init__(self, program, block_name, binding):
+        self.binding = binding
+        block_index = glGetUniformBlockIndex(program, block_name)
+        if block_index == GL_INVALID_INDEX:
+            raise ValueError("Uniform block '{}' is not active in the shader".format(block_name))
+        glUniformBlockBinding(program, block_index, binding)
+        block_size = np.zeros(1, dtype=np.int32)
+        glGetActiveUniformBlockiv(program, block_index, GL_UNIFORM_BLOCK_DATA_SIZE, block_size)
+        self.data = np.zeros(int(block_size[0]), dtype=np.uint8)
+        self.fields = self.get_fields(program, block_index)
+
+        self.buffer = glGenBuffers(1)
+        glBindBuffer(GL_UNIFORM_BUFFER, self.buffer)
+        glBufferData(GL_UNIFORM_BUFFER, self.data.nbytes, None, GL_DYNAMIC_DRAW)
+        glBindBuffer(GL_UNIFORM_BUFFER, 0)
+        self.dirty_start, self.dirty_end = len(self.data), 0
+
+    @staticmethod
+    def get_fields(program, block_index):
+        # Member offsets and array strides are resolved once after linking, keyed by name without "[0]"
+        uniforms_count = glGetProgramiv(program, GL_ACTIVE_UNIFORMS)
+        indices = np.arange(uniforms_count, dtype=np.uint32)
+        params = {}
+        for pname in (GL_UNIFORM_BLOCK_INDEX, GL_UNIFORM_OFFSET, GL_UNIFORM_ARRAY_STRIDE):
+            params[pname] = np.zeros(uniforms_count, dtype=np.int32)
+            glGetActiveUniformsiv(program, uniforms_count, indices, pname, params[pname])
+        fields = {}
+        for ind in np.flatnonzero(params[GL_UNIFORM_BLOCK_INDEX] == block_index):
+            name = glGetActiveUniform(program, int(ind))[0]
+            if not isinstance(name, bytes):
+                name = bytes(bytearray(name))
+            name = name.split(b'\0')[0].decode('ASCII').split('[')[0]
+            fields[name] = (int(params[GL_UNIFORM_OFFSET][ind]), int(params[GL_UNIFORM_ARRAY_STRIDE][ind]))
+        return fields
+
+    def set(self, name, value, dtype=np.float32):
+        # Like glUniform* with location -1, values of members the compiler dropped are ignored
+        if name not in self.fields:
+            return
+        offset, stride = self.fields[name]
+        value = np.asarray(value, dtype=dtype)
+        if stride == 0:
+            # Matrices are declared row_major, so numpy's row-major layout matches the block layout
+            element_bytes = value.tobytes()
+            self.data[offset:offset + len(element_bytes)] = np.frombuffer(element_bytes, np.uint8)
+            end = offset + len(element_bytes)
+        else:
+            elements = value.reshape(len(value), -1)
+            element_size = elements.itemsize * elements.shape[1]
+            strided = self.data[offset:offset + stride * len(elements)].reshape(len(elements), stride)
+            strided[:, :element_size] = elements.view(np.uint8).reshape(len(elements), element_size)
+            end = offset + stride * (len(elements) - 1) + element_size
+        self.dirty_start = min(self.dirty_start, offset)
+        self.dirty_end = max(self.dirty_end, end)
+
+    def upload(self):
+        glBindBufferBase(GL_UNIFORM_BUFFER, self.binding, self.buffer)
+        if self.dirty_start < self.dirty_end:
+            glBufferSubData(GL_UNIFORM_BUFFER, self.dirty_start, self.dirty_end - self.dirty_start,
+                            self.data[self.dirty_start:self.dirty_end])
+            self.dirty_start, self.dirty_end = len(self.data), 0
+
+    def release(self):
+        glDeleteBuffers(1, [self.buffer])
@@ -1,60 +1,199 @@
 import os
+import mmap
+import struct
 import trimesh
 import numpy as np
 import fnmatch
-from zipfile import ZipFile
+from zipfile import ZipFile, ZIP_STORED
 from io import BytesIO
+from .scan_cache import PointCloudArrays
 
-def open_from_zip(zippath, datapath, return_zip_path = False):
-    input_zip = ZipFile(zippath)
+ply_types = {'char': 'i1', 'int8': 'i1', 'uchar': 'u1', 'uint8': 'u1', 'short': 'i2', 'int16': 'i2',
+             'ushort': 'u2', 'uint16': 'u2', 'int': 'i4', 'int32': 'i4', 'uint': 'u4', 'uint32': 'u4',
+             'float': 'f4', 'float32': 'f4', 'double': 'f8', 'float64': 'f8'}
+
+
+class UnsupportedPLYLayout(ValueError):
+    # Valid PLY files the streaming reader does not handle, they are loaded with trimesh instead
+    pass
+
+
+def find_in_zip(input_zip, datapath):
     match_fn = lambda x: fnmatch.fnmatch(x, datapath)
     filenames = list(filter(match_fn, input_zip.namelist()))
     if len(filenames) == 0:
         raise FileNotFoundError("No file matching '{}' in archive".format(datapath))
     elif len(filenames) > 1:
         raise FileNotFoundError("More than one file matching '{}' exists in archive: {}".format(datapath, filenames))
-    else:
-        filename = filenames[0]
-        filehandler = BytesIO(input_zip.read(filename))
-        if return_zip_path:
-            return filehandler, filename
-        return filehandler
+    return filenames[0]
+
+
+def open_from_zip(zippath, datapath, return_zip_path = False):
+    input_zip = ZipFile(zippath)
+    filename = find_in_zip(input_zip, datapath)
+    filehandler = BytesIO(input_zip.read(filename))
+    if return_zip_path:
+        return filehandler, filename
+    return filehandler
+
+
+def read_ply_header(filehandler):
+    # Returns the number of vertices, their record dtype and the header length in bytes
+    line = filehandler.readline()
+    if line.strip() != b'ply':
+        raise ValueError("Not a PLY file")
+    # Line endings may be CRLF, so lengths are taken from the lines as read
+    header_len = len(line)
+    vertex_count, fields, current_element, byte_order = None, [], None, None
+    while True:
+        line = filehandler.readline()
+        if not line:
+            raise ValueError("PLY header is not terminated")
+        header_len += len(line)
+        tokens = line.decode('ASCII').split()
+        if len(tokens) == 0 or tokens[0] in ('comment', 'obj_info'):
+            continue
+        if tokens[0] == 'end_header':
+            break
+        if tokens[0] == 'format':
+            if tokens[1] == 'binary_little_endian':
+                byte_order = '<'
+            elif tokens[1] == 'binary_big_endian':
+                byte_order = '>'
+            else:
+                raise UnsupportedPLYLayout("Only binary PLY files can be streamed")
+        elif tokens[0] == 'element':
+            if vertex_count is None and tokens[1] != 'vertex':
+                raise UnsupportedPLYLayout("Vertex element has to be the first element of the PLY file")
+            current_element = tokens[1]
+            if current_element == 'vertex':
+                vertex_count = int(tokens[2])
+        elif tokens[0] == 'property' and current_element == 'vertex':
+            if tokens[1] == 'list':
+                raise UnsupportedPLYLayout("List properties of vertices are not supported")
+            fields.append((tokens[2], byte_order + ply_types[tokens[1]]))
+    if vertex_count is None:
+        raise ValueError("PLY file has no vertex element")
+    return vertex_count, np.dtype(fields), header_len
+
 
+def get_field_view(records, names):
+    # Strided view on consecutive fields of the same type, copy otherwise
+    dtype = records.dtype
+    offsets = [dtype.fields[name][1] for name in names]
+    field_dtypes = [dtype.fields[name][0] for name in names]
+    itemsize = field_dtypes[0].itemsize
+    if all(x == field_dtypes[0] for x in field_dtypes) and \
+            all(offsets[i] == offsets[0] + i * itemsize for i in range(len(names))):
+        return np.ndarray((len(records), len(names)), field_dtypes[0], buffer=records,
+                          offset=offsets[0], strides=(dtype.itemsize, itemsize))
+    return np.stack([records[name] for name in names], axis=1)
 
-def load_pc_from_zip(zippath, datapath):
-    filehandler, filename = open_from_zip(zippath, datapath, return_zip_path = True)
+
+def get_zip_entry_offset(zippath, zipinfo):
+    # Offset of the entry data in the archive (after the local file header)
+    with open(zippath, 'rb') as zipfile:
+        zipfile.seek(zipinfo.header_offset)
+        local_header = zipfile.read(30)
+    name_len, extra_len = struct.unpack('<HH', local_header[26:30])
+    return zipinfo.header_offset + 30 + name_len + extra_len
+
+
+def stream_ply_from_zip(zippath, datapath, chunk_size=64 * 1024 ** 2):
+    with ZipFile(zippath) as input_zip:
+        filename = find_in_zip(input_zip, datapath)
+    return stream_ply_entry(zippath, filename, chunk_size)
+
+
+def stream_ply_entry(zippath, filename, chunk_size=64 * 1024 ** 2):
+    # Same as stream_ply_from_zip for an exact entry name
+    with ZipFile(zippath) as input_zip:
+        zipinfo = input_zip.getinfo(filename)
+        with input_zip.open(filename) as filehandler:
+            vertex_count, vertex_dtype, header_len = read_ply_header(filehandler)
+            color_names = [x for x in ('red', 'green', 'blue', 'alpha') if x in vertex_dtype.names]
+            if zipinfo.compress_type == ZIP_STORED:
+                # Uncompressed entry: map the archive and point the arrays at the entry data directly
+                data_offset = get_zip_entry_offset(zippath, zipinfo)
+                with open(zippath, 'rb') as zipfile:
+                    mapped = mmap.mmap(zipfile.fileno(), 0, access=mmap.ACCESS_READ)
+                records = np.frombuffer(mapped, vertex_dtype, count=vertex_count, offset=data_offset + header_len)
+                vertices = get_field_view(records, ['x', 'y', 'z'])
+                colors = get_field_view(records, color_names) if len(color_names) > 0 else \
+                    get_default_colors(vertex_count)
+                return PointCloudArrays(vertices, colors)
+            # Compressed entry: decompress chunk by chunk into preallocated arrays
+            vertices = np.empty((vertex_count, 3), dtype=np.float32)
+            colors = np.empty((vertex_count, len(color_names)), dtype=np.uint8) if len(color_names) > 0 else None
+            records_per_chunk = max(1, chunk_size // vertex_dtype.itemsize)
+            start = 0
+            while start < vertex_count:
+                count = min(records_per_chunk, vertex_count - start)
+                buf = filehandler.read(count * vertex_dtype.itemsize)
+                if len(buf) < count * vertex_dtype.itemsize:
+                    raise ValueError("PLY file is truncated")
+                records = np.frombuffer(buf, vertex_dtype)
+                vertices[start:start + count] = get_field_view(records, ['x', 'y', 'z'])
+                if colors is not None:
+                    colors[start:start + count] = get_field_view(records, color_names)
+                start += count
+            return PointCloudArrays(vertices, get_default_colors(vertex_count) if colors is None else colors)
+
+
+def get_default_colors(count):
+    # Points of a PLY without color properties are drawn white
+    return np.full((count, 4), 255, dtype=np.uint8)
+
+
+def load_pc_from_zip(zippath, datapath, cache=None):
+    """
+    Loads a point cloud from a zip archive. PLY files (and everything read through the cache) are returned
+    as PointCloudArrays with `vertices` and `colors` arrays rather than a trimesh object; other formats
+    are still loaded with trimesh.
+    """
+    with ZipFile(zippath) as input_zip:
+        filename = find_in_zip(input_zip, datapath)
+    if cache is not None:
+        pointcloud = cache.get(zippath, filename)
+        if pointcloud is None:
+            mesh = load_pc_entry(zippath, filename)
+            pointcloud = cache.put(zippath, filename, mesh.vertices, mesh.colors)
+        return pointcloud
+    return load_pc_entry(zippath, filename)
+
+
+def load_pc_entry(zippath, filename):
+    # The entry name is used as is, names with wildcard characters are not matched again
+    if os.path.splitext(filename)[1].lower() == '.ply':
+        try:
+            return stream_ply_entry(zippath, filename)
+        except UnsupportedPLYLayout:
+            pass
+    with ZipFile(zippath) as input_zip:
+        filehandler = BytesIO(input_zip.read(filename))
     ext = os.path.splitext(filename)[1][1:]
     mesh = trimesh.load(filehandler, ext, process=False)
     return mesh
 
 
+def get_camera_positions(xyz_angs, positions):
+    # (N,4,4) camera poses T * Rz * Ry * Rx, the rotation product is expanded per element
+    xyz_angs = np.asarray(xyz_angs, dtype=np.float64)
+    (sx, sy, sz), (cx, cy, cz) = np.sin(xyz_angs).T, np.cos(xyz_angs).T
+    camera_poses = np.zeros((len(xyz_angs), 4, 4))
+    camera_poses[:, 0, 0] = cz * cy
+    camera_poses[:, 0, 1] = cz * sy * sx - sz * cx
+    camera_poses[:, 0, 2] = cz * sy * cx + sz * sx
+    camera_poses[:, 1, 0] = sz * cy
+    camera_poses[:, 1, 1] = sz * sy * sx + cz * cx
+    camera_poses[:, 1, 2] = sz * sy * cx - cz * sx
+    camera_poses[:, 2, 0] = -sy
+    camera_poses[:, 2, 1] = cy * sx
+    camera_poses[:, 2, 2] = cy * cx
+    camera_poses[:, :3, 3] = positions
+    camera_poses[:, 3, 3] = 1.
+    return camera_poses
+
+
 def get_camera_position(xyz_ang, pos):
-    camera_pose = np.array([
-        [1.0, 0, 0, pos[0]],
-        [0.0, 1.0, 0.0, pos[1]],
-        [0.0, 0, 1.0, pos[2]],
-        [0.0, 0.0, 0.0, 1.0],
-    ])
-    sin, cos = [np.sin(a) for a in xyz_ang], [np.cos(a) for a in xyz_ang]
-    x_rot = np.array(
-        [
-            [1.0, 0, 0, 0.0],
-            [0.0, cos[0], -sin[0], 0.0],
-            [0.0, sin[0], cos[0], 0.0],
-            [0.0, 0.0, 0.0, 1.0],
-        ])
-    y_rot = np.array(
-        [
-            [cos[1], 0, sin[1], 0.0],
-            [0.0, 1.0, 0.0, 0.0],
-            [-sin[1], 0, cos[1], 0.0],
-            [0.0, 0.0, 0.0, 1.0],
-        ])
-    z_rot = np.array(
-        [
-            [cos[2], -sin[2], 0, 0.0],
-            [sin[2], cos[2], 0.0, 0.0],
-            [0.0, 0.0, 1.0, 0.0],
-            [0.0, 0.0, 0.0, 1.0],
-        ])
-    return camera_pose.dot(z_rot.dot(y_rot.dot(x_rot)))
+    return get_camera_positions(np.asarray(xyz_ang)[None], np.asarray(pos)[None])[0]
@@ -0,0 +1,63 @@
+import os
+import numpy as np
+from OpenGL.GL import *
+from .shader_loader import Shader
+
+
+class VisibilityAccumulator:
+    # Accumulates per-id visibility over rendered frames on the GPU: after each frame a compute pass
+    # reads the id attachment and updates counters in shader storage buffers, nothing is read back until get_counts
+    group_size = 16
+
+    def __init__(self, ids_count):
+        self.ids_count = ids_count
+        self.shader = Shader()
+        dirname = os.path.dirname(os.path.abspath(__file__))
+        self.shader.initComputeShaderFromGLSL([os.path.join(dirname, "shaders/compute_visibility.glsl")])
+        self.uniform_ids = {k: glGetUniformLocation(self.shader.program, k)
+                            for k in ['region', 'frame_index', 'ids_count']}
+        self.buffers = [int(x) for x in np.atleast_1d(glGenBuffers(3))]
+        for buffer in self.buffers:
+            glBindBuffer(GL_SHADER_STORAGE_BUFFER, buffer)
+            glBufferData(GL_SHADER_STORAGE_BUFFER, max(ids_count, 1) * 4, None, GL_DYNAMIC_COPY)
+        glBindBuffer(GL_SHADER_STORAGE_BUFFER, 0)
+        self.reset()
+
+    def reset(self):
+        for buffer, value in zip(self.buffers, [0, 0, -1]):
+            glBindBuffer(GL_SHADER_STORAGE_BUFFER, buffer)
+            glClearBufferData(GL_SHADER_STORAGE_BUFFER, GL_R32I, GL_RED_INTEGER, GL_INT,
+                              np.array([value], dtype=np.int32))
+        glBindBuffer(GL_SHADER_STORAGE_BUFFER, 0)
+        self.frames_count = 0
+
+    def accumulate(self, ids_texture, region):
+        x, y, width, height = region
+        self.shader.begin()
+        glUniform4i(self.uniform_ids['region'], x, y, width, height)
+        glUniform1i(self.uniform_ids['frame_index'], self.frames_count)
+        glUniform1i(self.uniform_ids['ids_count'], self.ids_count)
+        glBindImageTexture(0, ids_texture, 0, GL_FALSE, 0, GL_READ_ONLY, GL_R32I)
+        for binding, buffer in enumerate(self.buffers):
+            glBindBufferBase(GL_SHADER_STORAGE_BUFFER, binding, buffer)
+        glDispatchCompute((width + self.group_size - 1) // self.group_size,
+                          (height + self.group_size - 1) // self.group_size, 1)
+        # Counter updates of this pass must be visible to the next one
+        glMemoryBarrier(GL_SHADER_STORAGE_BARRIER_BIT)
+        self.shader.end()
+        self.frames_count += 1
+
+    def get_counts(self):
+        # (frames_visible, pixels_covered) per id, the only readback of the whole accumulation
+        glMemoryBarrier(GL_BUFFER_UPDATE_BARRIER_BIT)
+        counts = []
+        for buffer in self.buffers[:2]:
+            glBindBuffer(GL_SHADER_STORAGE_BUFFER, buffer)
+            data = glGetBufferSubData(GL_SHADER_STORAGE_BUFFER, 0, self.ids_count * 4)
+            counts.append(np.frombuffer(data, np.uint32).copy())
+        glBindBuffer(GL_SHADER_STORAGE_BUFFER, 0)
+        return counts
+
+    def release(self):
+        glDeleteBuffers(len(self.buffers), self.buffers)
+        glDeleteProgram(self.shader.program)
@@ -1,13 +1,24 @@
+import os
 import json
+import shutil
+import tempfile
+import subprocess
 import numpy as np
+import multiprocessing
+from multiprocessing.connection import wait
 from tqdm import trange
-from queue import SimpleQueue
 from argparse import ArgumentParser
 from videoio import VideoWriter, VideoReader, read_video_params
 
 from egl_renderer import PointCloudRenderer
-from egl_renderer.libegl import EGLContext
+from egl_renderer.libegl import EGLContext, devices
 from egl_renderer.utils import load_pc_from_zip
+from egl_renderer.scan_cache import ScanCache
+from egl_renderer.pose_track import PoseTrack
+from egl_renderer.camera import get_view_matrices
+from egl_renderer.pipeline import PrefetchIterator, ConsumerThread, format_stats
+from egl_renderer.streaming import ChunkStore
+from egl_renderer.frame_reuse import FrameReuse
 
 known_cameras = {
     '029756': {'camera_model': 'opencv',
@@ -20,43 +31,60 @@ known_cameras = {
                'resolution': (1920, 1080)}
 }
 
-if __name__ == '__main__':
-    parser = ArgumentParser()
-    parser.add_argument("input_loc", help="Localization file")
-    parser.add_argument("input_pczip", help="3D scan zip file")
-    parser.add_argument("output", help="Output video")
-    parser.add_argument("-iv", "--input_video", help="Input video from the camera")
-    parser.add_argument("-res", "--resolution", nargs=2, type=int, help="Overwrite rendering resolution")
-    parser.add_argument("-c", "--camera", choices=list(known_cameras.keys()), required=True,
-                        help="Camera model (available choises: "+", ".join(sorted(known_cameras.keys()))+")")
-    parser.add_argument('-tf', '--total_frames', default=None, type=int, help="Maximum amount of frames to render")
-    parser.add_argument('-sf', '--starting_frame', default=0, type=int, help="Staring frame number")
-    parser.add_argument('--far', type=float, default=100., help="Maximum rendering distance")
-    parser.add_argument("--split_videoside", choices=['l', 'r', 'left', 'right'], default='l',
-                        help="Input video side on the split view")
-
-    args = parser.parse_args()
-
-    nosplit = args.input_video is None
-    try:
-        pointcloud = load_pc_from_zip(args.input_pczip, "pointcloud.ply")
-    except FileNotFoundError:
-        pointcloud = load_pc_from_zip(args.input_pczip, "*/pointcloud.ply")
+def get_resolution(args):
     camera = known_cameras[args.camera]
-
     resolution = args.resolution
+    video_scaling_required = False
     if not resolution:
         resolution = camera['resolution']
-        if not nosplit:
+        if args.input_video is not None:
             videoparams = read_video_params(args.input_video)
             video_resolution = (videoparams['width'], videoparams['height'])
             video_scaling_required = any([x!=y for x,y in zip(resolution,video_resolution)])
+    return tuple(resolution), video_scaling_required
 
+
+def get_frame_range(args):
+    max_frame_number = PoseTrack.load(args.input_loc).last_frame
+    if args.total_frames:
+        max_frame_number = min(max_frame_number, args.starting_frame + args.total_frames - 1)
+    if args.input_video is not None:
+        max_frame_number = min(max_frame_number,
+                               args.starting_frame+len(VideoReader(args.input_video, start_frame=args.starting_frame))-1)
+    return args.starting_frame, max_frame_number
+
+
+def load_scan(args, scan_cache):
+    try:
+        return load_pc_from_zip(args.input_pczip, "pointcloud.ply", cache=scan_cache)
+    except FileNotFoundError:
+        return load_pc_from_zip(args.input_pczip, "*/pointcloud.ply", cache=scan_cache)
+
+
+def open_chunk_store(args, scan_cache):
+    # By default the chunked scan is kept as one more scan cache entry, so it is evicted like the others
+    path = args.chunk_store
+    if path is None:
+        path = os.path.join(scan_cache.cache_dir, ScanCache.get_key(args.input_pczip, 'pointcloud.ply/chunks'))
+    return ChunkStore.open_or_build(lambda: load_scan(args, scan_cache), path)
+
+
+def render_sequence(args, starting_frame, max_frame_number, output, device=None, progress_position=0):
+    nosplit = args.input_video is None
+    scan_cache = ScanCache(args.scan_cache, args.scan_cache_size) if args.scan_cache else None
+    streaming = args.gpu_budget is not None
+    if streaming:
+        chunk_store = open_chunk_store(args, scan_cache)
+    else:
+        pointcloud = load_scan(args, scan_cache)
+    camera = known_cameras[args.camera]
+
+    resolution, video_scaling_required = get_resolution(args)
     print(f"Rendering at {resolution} resolution")
 
     ctx = EGLContext()
 
-    if not ctx.initialize(*resolution):
+    if not ctx.initialize(*resolution, device=device, surfaceless=True):
         print('Could not initialize OpenGL context.')
 
     opencv_renderer = PointCloudRenderer(*resolution)
@@ -67,73 +95,278 @@ if __name__ == '__main__':
     center = camera['camera_params'][2:4]
     dist_coeffs = camera['camera_params'][4:]+[0.]
 
-    opencv_renderer.init_context(pointcloud, camera['camera_model'], image_size=resolution, focal_dist=focal_dist,
-                                 center=center,
-                                 distorsion_coeffs=dist_coeffs, far=args.far)
-    s_results = json.load(open(args.input_loc))
-    max_frame_number = max((int(k) for k in s_results.keys()))
-    if args.total_frames:
-        max_frame_number = min(max_frame_number, args.starting_frame + args.total_frames - 1)
+    opencv_renderer.init_context(None if streaming else pointcloud, camera['camera_model'], image_size=resolution,
+                                 focal_dist=focal_dist, center=center,
+                                 distorsion_coeffs=dist_coeffs, far=args.far, top_down=True)
+    if streaming:
+        opencv_renderer.scan = opencv_renderer.add_streaming_object(chunk_store, args.gpu_budget * 1024 ** 2,
+                                                                    name='scan')
+    pose_track = PoseTrack.load(args.input_loc).get_range(starting_frame, max_frame_number + 1)
+    view_matrices = get_view_matrices(pose_track.quaternion, pose_track.position)
 
     if not nosplit:
         if video_scaling_required:
             video_iterator = iter(VideoReader(args.input_video, output_resolution=resolution,
-                                              start_frame=args.starting_frame))
+                                              start_frame=starting_frame))
         else:
-            video_iterator = iter(VideoReader(args.input_video, start_frame=args.starting_frame))
-        max_frame_number = min(max_frame_number, args.starting_frame+len(video_iterator)-1)
-
-    tqdm_iter = trange(args.starting_frame, max_frame_number+1)
-
-    last_frame = None
-    frame_queue = SimpleQueue()
-    queue_size = 50
-    with VideoWriter(args.output, resolution=resolution, fps=30, preset='veryfast') as vw:
-        def process_frame(delete_pbo = True):
-            if frame_queue.qsize() >= queue_size:
-                last_frame = frame_queue.get()
+            video_iterator = iter(VideoReader(args.input_video, start_frame=starting_frame))
+        # Decoding runs ahead on its own thread
+        video_iterator = PrefetchIterator(video_iterator, args.prefetch, 'decode')
+
+    tqdm_iter = trange(starting_frame, max_frame_number+1, position=progress_position)
+
+    queue_size = 4
+    stream_lookahead, stream_max_uploads = 15, 16
+    opencv_renderer.init_pbo_ring(queue_size)
+    pbo_ring = opencv_renderer.pbo_ring
+    if not nosplit:
+        # The video is composited into the framebuffer, only the final frame is read back
+        opencv_renderer.init_compositor(args.split_layout if args.split_layout == 'pip' else
+                                        ('right' if args.split_videoside[0] == 'r' else 'left'),
+                                        split=args.split_position, alpha=args.video_alpha)
+        # Only the part of the frame the video leaves visible is rasterized
+        opencv_renderer.set_render_region(opencv_renderer.compositor.get_render_region(), crop_readback=False)
+    # Without the video, frames with the same pose as the last rendered one are re-emitted as is
+    frame_reuse = FrameReuse(list(resolution) + camera['camera_params'] + [args.far], args.reuse_tolerance[0],
+                             np.deg2rad(args.reuse_tolerance[1])) if nosplit else None
+    # The encoder and the compositor only read frames, so all inactive frames and missing video frames share one
+    black_frame = np.zeros(resolution[::-1] + (3,), dtype=np.uint8)
+    blank_frames = 0
+    last_color = None
+    with VideoWriter(output, resolution=resolution, fps=30, preset='veryfast') as vw:
+        # GL work stays on this thread (it owns the context), encoding runs on a consumer thread
+        encoder = ConsumerThread(vw.write, args.prefetch, 'encode')
+
+        def process_frame():
+            nonlocal last_color
+            # Frames outlive the PBO slot they were read into, so each one is copied out of the ring;
+            # in top-down mode that is a plain copy and the frame goes to the encoder as is
+            tag, color = opencv_renderer.get_ring_color(np.empty(resolution[::-1] + (3,), dtype=np.uint8))
+            if tag == 'reuse':
+                color = last_color
+            elif color is None:
+                color = black_frame
             else:
-                last_frame = None
-            if last_frame is not None:
-                prev_orig_color, pbo, active = last_frame
-                if not active:
-                    color = np.zeros(resolution[::-1] + (3,), dtype=np.uint8)
-                else:
-                    color = opencv_renderer.get_requested_color(pbo, delete_pbo=delete_pbo)
-                    color = color[::-1]
+                last_color = color
+            encoder.submit(color)
+
+        try:
+            for frame_ind in tqdm_iter:
+                if len(pbo_ring) >= queue_size:
+                    process_frame()
+                track_ind = frame_ind - pose_track.first_frame
+                rendered = bool(pose_track.valid[track_ind])
+                reused = rendered and nosplit and frame_reuse.check(pose_track.quaternion[track_ind],
+                                                                    pose_track.position[track_ind])
+                if rendered and not reused:
+                    opencv_renderer.set_view_matrix(view_matrices[track_ind])
+                    opencv_renderer.draw()
+                if streaming:
+                    # Chunks of the next poses are uploaded while the GPU works on this frame
+                    upcoming = slice(track_ind + 1, track_ind + 1 + stream_lookahead)
+                    opencv_renderer.prefetch(view_matrices[upcoming][pose_track.valid[upcoming]],
+                                             max_uploads=stream_max_uploads)
                 if not nosplit:
-                    if args.split_videoside[0] == 'r':
-                        color = np.hstack([color[:, :resolution[0] // 2],
-                                           prev_orig_color[:, resolution[0] // 2:]])
-                    else:
-                        color = np.hstack([prev_orig_color[:, :resolution[0] // 2],
-                                           color[:, resolution[0] // 2:]])
-                vw.write(color)
-                return pbo
-            else:
-                return None
-
-        for frame_ind in tqdm_iter:
-            pbo = process_frame(False)
-            imname = str(frame_ind)
-            impos = s_results[imname] if imname in s_results else None
-            if impos is not None:
-                pos = np.array(impos['position'])
-                quat = np.array(impos['quaternion'])
-                opencv_renderer.locate_camera(quat, pos)
-                opencv_renderer.draw()
-                pbo = opencv_renderer.request_color_async(pbo)
-                active = True
-            else:
-                active = False
-            if nosplit:
-                orig_color = None
-            else:
-                try:
-                    orig_color = next(video_iterator)
-                except StopIteration:
-                    orig_color = np.zeros(resolution+(3,), dtype=np.uint8)
-            frame_queue.put((orig_color, pbo, active))
-        queue_size = 0
-        while not frame_queue.empty():
-            process_frame(True)
\ No newline at end of file
+                    try:
+                        orig_color = next(video_iterator)
+                    except StopIteration:
+                        orig_color = black_frame
+                    opencv_renderer.composite_video(orig_color, rendered)
+                if reused:
+                    # Neither drawn nor read back, the frame is taken from the last readback
+                    pbo_ring.push('reuse')
+                elif rendered or not nosplit:
+                    opencv_renderer.request_color_ring()
+                else:
+                    pbo_ring.push()
+                    blank_frames += 1
+            while len(pbo_ring) > 0:
+                process_frame()
+        finally:
+            encoder.close()
+            if not nosplit:
+                video_iterator.close()
+    if nosplit:
+        print("Frame reuse: {} reused, {} rendered, {} blank".format(frame_reuse.hits, frame_reuse.misses,
+                                                                       blank_frames))
+    if streaming:
+        scan = opencv_renderer.scan
+        print("Streaming: {} uploads, {} evictions, {} visible chunks not drawn in {} frames".format(
+            scan.uploads, scan.evictions, scan.dropped_chunks, scan.dropped_frames))
+    if args.pipeline_stats:
+        stats = [encoder.get_stats()] if nosplit else [video_iterator.queue.get_stats(), encoder.get_stats()]
+        print(format_stats(stats))
+
+def concat_videos(paths, output):
+    # Segments share the encoding parameters, so the concat demuxer can join them without re-encoding
+    list_path = os.path.join(os.path.dirname(paths[0]), 'segments.txt')
+    with open(list_path, 'w') as list_file:
+        for path in paths:
+            list_file.write("file '{}'\n".format(os.path.abspath(path)))
+    subprocess.run(['ffmpeg', '-y', '-loglevel', 'error', '-f', 'concat', '-safe', '0', '-i', list_path,
+                    '-c', 'copy', output], check=True)
+
+
+def get_worker_devices(args, workers):
+    if args.device is not None or os.environ.get('EGL_RENDERER_DEVICE'):
+        # All workers share the explicitly selected device
+        return [args.device] * workers
+    devices_count = max(len(devices.probe()), 1)
+    return [i % devices_count for i in range(workers)]
+
+
+def render_sharded(args, starting_frame, max_frame_number):
+    total_frames = max_frame_number - starting_frame + 1
+    workers = min(args.workers, total_frames)
+    worker_devices = get_worker_devices(args, workers)
+    bounds = np.linspace(starting_frame, max_frame_number + 1, workers + 1).round().astype(int)
+    segments_dir = tempfile.mkdtemp(prefix='.segments_', dir=os.path.dirname(os.path.abspath(args.output)))
+    segment_paths = [os.path.join(segments_dir, 'segment_{:04d}.mp4'.format(i)) for i in range(workers)]
+    # Each worker has to create its own EGL context, so the processes are spawned rather than forked
+    mp_context = multiprocessing.get_context('spawn')
+    processes = [mp_context.Process(target=render_sequence,
+                                    args=(args, int(bounds[i]), int(bounds[i + 1]) - 1, segment_paths[i],
+                                          worker_devices[i], i))
+                 for i in range(workers)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    failed = [i for i, process in enumerate(processes) if process.exitcode != 0]
+    if len(failed) > 0:
+        raise RuntimeError("Rendering failed in shards {}, segments are kept in {}".format(failed, segments_dir))
+    concat_videos(segment_paths, args.output)
+    shutil.rmtree(segments_dir)
+
+
+# Options that change the rendered frames; segments of a checkpoint are reused only if all of them match
+checkpoint_options = ['input_loc', 'input_pczip', 'input_video', 'resolution', 'camera', 'far', 'split_videoside',
+                      'split_layout', 'split_position', 'video_alpha', 'reuse_tolerance', 'gpu_budget']
+
+
+def get_checkpoint_job(args):
+    job = {name: getattr(args, name) for name in checkpoint_options}
+    for name in ['input_loc', 'input_pczip', 'input_video']:
+        if job[name] is not None:
+            job[name] = os.path.abspath(job[name])
+    return job
+
+
+def save_manifest(manifest, path):
+    # Replaced atomically, an interrupted run leaves either the old or the new manifest
+    with open(path + '.tmp', 'w') as manifest_file:
+        json.dump(manifest, manifest_file, indent=1)
+    os.replace(path + '.tmp', path)
+
+
+def render_checkpointed(args, starting_frame, max_frame_number):
+    # The sequence is rendered as fixed-length segments; finished ones are recorded in the manifest,
+    # so a restarted run renders only the missing segments and then joins all of them
+    os.makedirs(args.checkpoint_dir, exist_ok=True)
+    manifest_path = os.path.join(args.checkpoint_dir, 'manifest.json')
+    job = get_checkpoint_job(args)
+    manifest = {'job': job, 'segments': []}
+    if os.path.isfile(manifest_path):
+        with open(manifest_path) as manifest_file:
+            manifest = json.load(manifest_file)
+        if manifest['job'] != job:
+            raise RuntimeError("Checkpoint directory {} belongs to a render with different options".format(
+                args.checkpoint_dir))
+    completed = {(start, end): filename for start, end, filename in manifest['segments']
+                 if os.path.isfile(os.path.join(args.checkpoint_dir, filename))}
+    segments = [(start, min(start + args.segment_length, max_frame_number + 1) - 1)
+                for start in range(starting_frame, max_frame_number + 1, args.segment_length)]
+    missing = [segment for segment in segments if segment not in completed]
+    print("Checkpoint: {} of {} segments done".format(len(segments) - len(missing), len(segments)))
+
+    # Each segment is rendered by its own process, at most `workers` at a time
+    workers = max(min(args.workers, len(missing)), 1)
+    worker_devices = get_worker_devices(args, workers)
+    free_workers = list(range(workers - 1, -1, -1))
+    mp_context = multiprocessing.get_context('spawn')
+    running = {}
+    failed = []
+    while len(missing) > 0 or len(running) > 0:
+        while len(missing) > 0 and len(free_workers) > 0:
+            start, end = missing.pop(0)
+            worker = free_workers.pop()
+            filename = 'segment_{:08d}_{:08d}.mp4'.format(start, end)
+            # Written under a temporary name, a killed process never leaves a complete-looking segment
+            process = mp_context.Process(target=render_sequence,
+                                         args=(args, start, end, os.path.join(args.checkpoint_dir, '.part_' + filename),
+                                               worker_devices[worker], worker))
+            process.start()
+            running[process.sentinel] = (process, worker, start, end, filename)
+        for sentinel in wait(list(running.keys())):
+            process, worker, start, end, filename = running.pop(sentinel)
+            process.join()
+            free_workers.append(worker)
+            if process.exitcode != 0:
+                failed.append((start, end))
+                continue
+            os.replace(os.path.join(args.checkpoint_dir, '.part_' + filename),
+                       os.path.join(args.checkpoint_dir, filename))
+            completed[(start, end)] = filename
+            manifest['segments'] = [[start, end, filename] for (start, end), filename in sorted(completed.items())]
+            save_manifest(manifest, manifest_path)
+    if len(failed) > 0:
+        raise RuntimeError("Rendering failed for frames {}, rerun to render the missing segments".format(
+            ", ".join("{}-{}".format(start, end) for start, end in failed)))
+    concat_videos([os.path.join(args.checkpoint_dir, completed[segment]) for segment in segments], args.output)
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument("input_loc", help="Localization file")
+    parser.add_argument("input_pczip", help="3D scan zip file")
+    parser.add_argument("output", help="Output video")
+    parser.add_argument("-iv", "--input_video", help="Input video from the camera")
+    parser.add_argument("-res", "--resolution", nargs=2, type=int, help="Overwrite rendering resolution")
+    parser.add_argument("-c", "--camera", choices=list(known_cameras.keys()), required=True,
+                        help="Camera model (available choises: "+", ".join(sorted(known_cameras.keys()))+")")
+    parser.add_argument('-tf', '--total_frames', default=None, type=int, help="Maximum amount of frames to render")
+    parser.add_argument('-sf', '--starting_frame', default=0, type=int, help="Staring frame number")
+    parser.add_argument('--far', type=float, default=100., help="Maximum rendering distance")
+    parser.add_argument("--split_videoside", choices=['l', 'r', 'left', 'right'], default='l',
+                        help="Input video side on the split view")
+    parser.add_argument("--split_layout", choices=['side', 'pip'], default='side',
+                        help="Split view layout: video on one side of the wipe position or picture-in-picture")
+    parser.add_argument("--split_position", type=float, default=0.5,
+                        help="Wipe position of the split view as a fraction of the frame width")
+    parser.add_argument("--video_alpha", type=float, default=1.,
+                        help="Opacity of the input video over the render")
+    parser.add_argument("--scan_cache", default="~/.cache/hps_dataset_scripts/scans",
+                        help="Directory for the binary scan cache (pass empty string to disable)")
+    parser.add_argument("--scan_cache_size", type=float, default=20., help="Maximum scan cache size in GB")
+    parser.add_argument("--prefetch", type=int, default=8,
+                        help="Number of frames queued between the decoding, rendering and encoding threads")
+    parser.add_argument("--pipeline_stats", action='store_true',
+                        help="Print queue occupancy and stall times of the pipeline stages")
+    parser.add_argument("--reuse_tolerance", nargs=2, type=float, default=[0., 0.], metavar=('METERS', 'DEGREES'),
+                        help="Poses closer than this to the last rendered one reuse its frame (default: equal poses)")
+    parser.add_argument("--gpu_budget", type=float, default=None,
+                        help="Stream the scan from disk through at most this many MB of GPU buffers")
+    parser.add_argument("--chunk_store", default=None,
+                        help="Directory of the chunked scan used for streaming (default: inside the scan cache)")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Number of rendering processes, each renders a contiguous part of the sequence")
+
+    parser.add_argument("--checkpoint_dir", default=None,
+                        help="Render in segments kept in this directory; an interrupted run continues from the "
+                             "missing segments")
+    parser.add_argument("--segment_length", type=int, default=1800, help="Frames per checkpoint segment")
+    parser.add_argument("--device", default=None,
+                        help="EGL device index or DRM device path (default: EGL_RENDERER_DEVICE variable or first "
+                             "working device)")
+
+    args = parser.parse_args()
+    if args.gpu_budget is not None and args.chunk_store is None and not args.scan_cache:
+        parser.error("--gpu_budget needs --chunk_store when the scan cache is disabled")
+
+    starting_frame, max_frame_number = get_frame_range(args)
+    if args.checkpoint_dir is not None:
+        render_checkpointed(args, starting_frame, max_frame_number)
+    elif args.workers > 1:
+        render_sharded(args, starting_frame, max_frame_number)
+    else:
+        render_sequence(args, starting_frame, max_frame_number, args.output, args.device)